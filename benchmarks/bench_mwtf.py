@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil -*-
+"""Compare mwtf host identity helpers with the previous popen implementation.
+
+usage: python benchmarks/bench_mwtf.py [iterations]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "wtftools"))
+
+import mwtf  # noqa: E402
+
+
+def popen_hostname():
+    return os.popen("hostname").read().rstrip()
+
+
+def popen_domainname():
+    return os.popen("hostname -d").read().rstrip()
+
+
+def popen_fqdn():
+    return "%s.%s" % (popen_hostname(), popen_domainname())
+
+
+def popen_secsepochsince():
+    return int(os.popen("date '+%s'").read().rstrip())
+
+
+def cold(func):
+    def wrapper():
+        mwtf.invalidate_host_identity()
+        return func()
+
+    return wrapper
+
+
+def report(label, func, number):
+    elapsed = timeit.timeit(func, number=number)
+    print("%-28s %12.2f us/call" % (label, elapsed / number * 1e6))
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    report("popen hostname", popen_hostname, number)
+    report("mwtf hostname (cold)", cold(mwtf.hostname), number)
+    report("mwtf hostname (cached)", mwtf.hostname, number * 100)
+    report("popen fqdn", popen_fqdn, number)
+    report("mwtf fqdn (cold)", cold(mwtf.fqdn), number)
+    report("mwtf fqdn (cached)", mwtf.fqdn, number * 100)
+    report("popen secsepochsince", popen_secsepochsince, number)
+    report("mwtf secsepochsince", mwtf.secsepochsince, number * 100)
+    report("mwtf file_age", lambda: mwtf.file_age(__file__), number * 100)
+
+
+if __name__ == "__main__":
+    main()
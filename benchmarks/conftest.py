@@ -0,0 +1,49 @@
+import glob
+import logging
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+# the wtftools modules import each other by their bare module names
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "wtftools"))
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def pytest_configure(config):
+    """Measure without comparing while the storage holds no saved run.
+
+    tox -e bench compares against the run saved by tox -e bench-baseline,
+    which is machine specific and not committed; on a fresh checkout the
+    compare options would otherwise abort the session.
+    """
+    if not config.getoption("benchmark_compare", None):
+        return
+    storage = config.getoption("benchmark_storage")
+    if storage.startswith("file://"):
+        storage = storage[len("file://") :]
+    if glob.glob(os.path.join(storage, "*", "*.json")):
+        return
+    config.option.benchmark_compare = None
+    config.option.benchmark_compare_fail = None
+    print(
+        "no saved benchmark run in %s, run tox -e bench-baseline to compare" % storage,
+        file=sys.stderr,
+    )
+
+
+@pytest.fixture
+def summary_file():
+    return os.path.join(FIXTURES, "last_run_summary.yaml")
+
+
+@pytest.fixture
+def wtfo():
+    import mwtfscribe
+
+    mwtfscribe.reset_sinks()
+    yield logging.getLogger("wtfo")
+    mwtfscribe.reset_sinks()
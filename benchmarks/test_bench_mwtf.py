@@ -0,0 +1,46 @@
+import os
+
+import mwtf
+import mwtfsummary
+
+
+def test_hostname(benchmark):
+    assert benchmark(mwtf.hostname)
+
+
+def test_fqdn(benchmark):
+    assert benchmark(mwtf.fqdn)
+
+
+def test_fqdn_cold(benchmark):
+    def cold():
+        mwtf.invalidate_host_identity()
+        return mwtf.fqdn()
+
+    assert benchmark(cold)
+
+
+def test_file_age(benchmark):
+    assert benchmark(mwtf.file_age, __file__) >= 0
+
+
+def test_file_age_missing(benchmark):
+    assert (
+        benchmark(mwtf.file_age, os.path.join(os.path.dirname(__file__), "nope")) == 0
+    )
+
+
+def test_load_yaml_safe(benchmark, summary_file):
+    data = benchmark(mwtf.load_yaml, summary_file, mwtf.YAML_SAFE_LOADER)
+    assert data["resources"]["total"] == 1184
+
+
+def test_load_yaml_full(benchmark, summary_file):
+    data = benchmark(mwtf.load_yaml, summary_file)
+    assert data["time"]["last_run"] == 1665912400
+
+
+def test_summary_cached(benchmark, summary_file):
+    mwtfsummary.forget()
+    summary = benchmark(mwtfsummary.load, summary_file)
+    assert summary.resource_count() == 1184
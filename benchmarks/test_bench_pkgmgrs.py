@@ -0,0 +1,40 @@
+import pkgmgrs
+import pytest
+
+
+class StubMixin:
+    """Record backend commands instead of running them."""
+
+    def execute(self, cmd):
+        self.ran.append(cmd)
+        return 0
+
+
+class StubPacman(StubMixin, pkgmgrs.PacmanHandler):
+    pass
+
+
+class StubYum(StubMixin, pkgmgrs.YumHandler):
+    pass
+
+
+@pytest.fixture(params=[StubPacman, StubYum])
+def handler(request):
+    handler = request.param({"refresh": False, "names-only": None})
+    handler.ran = []
+    return handler
+
+
+@pytest.mark.parametrize(
+    "action, args",
+    [("info", ["bash"]), ("file", ["/usr/bin/bash"]), ("search", ["vim"])],
+)
+def test_action(benchmark, handler, action, args):
+    assert benchmark(handler.action, action, args) == 0
+    assert handler.ran
+
+
+def test_dispatch(benchmark, handler):
+    assert (
+        benchmark(handler.dispatch, "install", ["bash", "zsh"])[0] == "install_action"
+    )
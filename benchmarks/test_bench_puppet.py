@@ -0,0 +1,57 @@
+import mwtfpuppet
+import pytest
+
+CONF = """[main]
+vardir = /opt/puppetlabs/puppet/cache
+logdir = /var/log/puppetlabs/puppet
+ssldir = $vardir/ssl
+
+[agent]
+server = puppet.example.com
+runinterval = 1800
+environment = production
+report = true
+"""
+
+
+@pytest.fixture
+def config(tmp_path, wtfo):
+    conf = tmp_path / "puppet.conf"
+    conf.write_text(CONF)
+    config = mwtfpuppet.PuppetConfig(
+        {
+            "flagdir": str(tmp_path / "flags"),
+            "caller": "bench",
+            "logfile": str(tmp_path / "log"),
+            "screen": False,
+        }
+    )
+    config.pathnames["config"] = {"pn": str(conf), "status": "good"}
+    yield config
+    mwtfpuppet.forget_settings()
+
+
+def test_show_flags(benchmark, config, capsys):
+    config.manage("debug", True)
+    benchmark(config.show_flags)
+    assert "wtfo_puppet_debug=True" in capsys.readouterr().out
+
+
+def test_manage(benchmark, config):
+    state = [False]
+
+    def toggle():
+        state[0] = not state[0]
+        return config.manage("nowarn", state[0])
+
+    benchmark(toggle)
+    assert config.errors == 0
+
+
+def test_snapshot(benchmark, config):
+    config.manage("stopped", True)
+    assert benchmark(config.snapshot)["stopped"].state
+
+
+def test_setting(benchmark, config):
+    assert benchmark(config.setting, "runinterval") == "1800"
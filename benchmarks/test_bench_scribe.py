@@ -0,0 +1,32 @@
+import mwtfscribe
+import pytest
+
+
+@pytest.mark.parametrize(
+    "format, queued", [("text", False), ("json", False), ("text", True)]
+)
+def test_record(benchmark, tmp_path, wtfo, format, queued):
+    scribe = mwtfscribe.Scribe(
+        {
+            "caller": "bench",
+            "logfile": str(tmp_path / "bench.log"),
+            "screen": False,
+            "format": format,
+            "queued": queued,
+            "overflow": "block",
+        }
+    )
+    benchmark(scribe.warn, "flag %s set", "debug")
+    scribe.flush()
+
+
+def test_filtered_record(benchmark, tmp_path, wtfo):
+    scribe = mwtfscribe.Scribe(
+        {"caller": "bench", "logfile": str(tmp_path / "bench.log"), "screen": False}
+    )
+    benchmark(scribe.debug, "below the level %s", "debug")
+
+
+def test_construct(benchmark, tmp_path, wtfo):
+    opts = {"caller": "bench", "logfile": str(tmp_path / "bench.log"), "screen": False}
+    benchmark(mwtfscribe.Scribe, opts)
@@ -25,6 +25,9 @@ automation and administration activities.",
     entry_points={
         "console_scripts": [
             "pupflag = wtftools.pupflag:main",
+            "pupconfig = wtftools.pupconfig:main",
+            "pupfanout = wtftools.pupfanout:main",
+            "pupmonitor = wtftools.pupmonitor:main",
         ],
     },
     classifiers=[
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the wtftools modules import each other by their bare module names
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "wtftools"))
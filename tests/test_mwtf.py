@@ -0,0 +1,113 @@
+import json
+import os
+import pstats
+import time
+
+import mwtf
+import pytest
+
+
+def test_hostname_matches_uname():
+    mwtf.invalidate_host_identity()
+    assert mwtf.hostname() == os.uname().nodename
+
+
+def test_fqdn_starts_with_short_hostname():
+    assert mwtf.fqdn().startswith(mwtf.hostname().partition(".")[0])
+
+
+def test_identity_invalidates_on_nodename_change(monkeypatch):
+    identity = mwtf.HostIdentity()
+    identity.hostname()
+    identity._domainname = "stale.example"
+    uname = os.uname()
+    fake = type(uname)(uname[:1] + ("renamed.example.com",) + uname[2:])
+    monkeypatch.setattr(os, "uname", lambda: fake)
+    assert identity.hostname() == "renamed.example.com"
+    assert identity.domainname() == "example.com"
+    assert identity.fqdn() == "renamed.example.com"
+
+
+def test_file_age(tmp_path):
+    path = tmp_path / "aged"
+    path.write_text("")
+    past = time.time() - 120
+    os.utime(path, (past, past))
+    assert 119 <= mwtf.file_age(str(path)) <= 125
+    assert mwtf.file_age(str(tmp_path / "missing")) == 0
+
+
+def test_metrics_export(tmp_path):
+    metrics = mwtf.Metrics(buckets=(0.1, 1.0))
+    metrics.count("wtftools_runs_total")
+    metrics.count("wtftools_runs_total", 2)
+    metrics.observe("wtftools_parse_seconds", 0.05, kind='a"b')
+    metrics.observe("wtftools_parse_seconds", 0.5, kind='a"b')
+    metrics.observe("wtftools_parse_seconds", 5, kind='a"b')
+    with metrics.span("wtftools_span_seconds", op="x"):
+        pass
+    text = metrics.prometheus()
+    assert "# TYPE wtftools_runs_total counter\nwtftools_runs_total 3\n" in text
+    assert 'wtftools_parse_seconds_bucket{kind="a\\"b",le="0.1"} 1' in text
+    assert 'wtftools_parse_seconds_bucket{kind="a\\"b",le="1.0"} 2' in text
+    assert 'wtftools_parse_seconds_bucket{kind="a\\"b",le="+Inf"} 3' in text
+    assert 'wtftools_parse_seconds_sum{kind="a\\"b"} 5.55' in text
+    assert 'wtftools_span_seconds_count{op="x"} 1' in text
+
+    metrics.write(str(tmp_path / "wtftools.prom"))
+    assert (tmp_path / "wtftools.prom").read_text() == text
+    metrics.write(str(tmp_path / "wtftools.json"))
+    data = json.loads((tmp_path / "wtftools.json").read_text())
+    histogram = data["histograms"][0]
+    assert histogram["labels"] == {"kind": 'a"b'}
+    assert histogram["buckets"] == {"0.1": 1, "1.0": 2}
+    assert histogram["count"] == 3
+
+
+def test_options_share_the_registry():
+    mwtf.metrics().reset()
+    first, second = mwtf.Options(), mwtf.Options()
+    with first.span("wtftools_test_seconds"):
+        second.count("wtftools_test_total", op="x")
+    counters, histograms = mwtf.metrics().snapshot()
+    assert counters[("wtftools_test_total", (("op", "x"),))] == 1
+    assert histograms[("wtftools_test_seconds", ())][0] == 1
+
+
+def busy(n):
+    return sum(i * i for i in range(n))
+
+
+def test_profiled_off_calls_through(tmp_path, monkeypatch):
+    monkeypatch.delenv("WTFTOOLS_PROFILE", raising=False)
+    assert mwtf.profiled({"profile_dir": str(tmp_path)}, busy, 10) == 285
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_profiled_cprofile(tmp_path, capsys):
+    opts = {
+        "profile": "cprofile",
+        "profile_dir": str(tmp_path / "profiles"),
+        "profile_top": 3,
+        "caller": "pupflag",
+    }
+    assert mwtf.profiled(opts, busy, 1000) == busy(1000)
+    (name,) = os.listdir(str(tmp_path / "profiles"))
+    assert name.startswith("pupflag-%s-" % mwtf.hostname())
+    assert name.endswith(".pstats")
+    stats = pstats.Stats(str(tmp_path / "profiles" / name))
+    assert any(func[2] == "busy" for func in stats.stats)
+    assert "Ordered by: cumulative time" in capsys.readouterr().err
+
+
+def test_profiled_sampling(tmp_path, capsys):
+    pytest.importorskip("pyinstrument")
+    opts = {"profile": "sampling", "profile_dir": str(tmp_path), "profile_top": 2}
+    mwtf.profiled(opts, busy, 300000)
+    (name,) = os.listdir(str(tmp_path))
+    assert name.endswith(".collapsed")
+    lines = (tmp_path / name).read_text().splitlines()
+    assert any("busy (" in line for line in lines)
+    stack, weight = lines[0].rsplit(" ", 1)
+    assert int(weight) > 0
+    assert "self secs" in capsys.readouterr().err
@@ -0,0 +1,71 @@
+import mwtfalertable
+import pytest
+
+
+class RecordingSink:
+    def __init__(self):
+        self.events = []
+
+    def raise_alert(self, alerter, alert):
+        self.events.append(("raise", alert["key"]))
+
+    def clear_alert(self, alerter, alert):
+        self.events.append(("clear", alert["key"]))
+
+
+@pytest.fixture
+def sink():
+    return RecordingSink()
+
+
+def make_alerter(sink, tmp_path, **opts):
+    options = {
+        "alert_sink": sink,
+        "alert_state": str(tmp_path / "alerts.json"),
+        "caller": "test",
+        "logfile": str(tmp_path / "log"),
+        "screen": False,
+    }
+    options.update(opts)
+    return mwtfalertable.Alerter(options)
+
+
+def test_only_transitions_reach_the_sink(sink, tmp_path):
+    alerter = make_alerter(sink, tmp_path, alert_burst=10)
+    args = {"key": "puppet.config.file.status", "subject": "File not found."}
+    for i in range(100):
+        alerter.raise_alert(args)
+    alerter.clear({"key": args["key"]})
+    alerter.clear({"key": args["key"]})
+    alerter.clear({"key": "never.raised"})
+    assert sink.events == [("raise", args["key"]), ("clear", args["key"])]
+
+
+def test_state_is_shared_and_persisted(sink, tmp_path):
+    first = make_alerter(sink, tmp_path)
+    assert first.raise_alert({"key": "shared.key"})
+    second = make_alerter(sink, tmp_path)
+    assert not second.raise_alert({"key": "shared.key"})
+
+    reloaded = mwtfalertable.AlertStore(str(tmp_path / "alerts.json"))
+    assert reloaded.raised() == ["shared.key"]
+
+
+def test_rate_limit_retries_later(sink, tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(mwtfalertable.time, "monotonic", lambda: now[0])
+    alerter = make_alerter(sink, tmp_path, alert_rate=0.1, alert_burst=1)
+    assert alerter.raise_alert({"key": "flappy"})
+    assert not alerter.clear({"key": "flappy"})
+    now[0] += 10
+    assert alerter.clear({"key": "flappy"})
+    assert sink.events == [("raise", "flappy"), ("clear", "flappy")]
+
+
+def test_token_bucket():
+    bucket = mwtfalertable.TokenBucket(1, 2)
+    start = bucket.stamp
+    assert bucket.allow(start)
+    assert bucket.allow(start)
+    assert not bucket.allow(start)
+    assert bucket.allow(start + 1)
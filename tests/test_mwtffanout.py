@@ -0,0 +1,99 @@
+import sys
+import time
+
+import mwtf
+import mwtffanout
+import pytest
+
+FLAGS = "wtfo_puppet_debug=%s\nwtfo_puppet_noipv6=False\n"
+
+
+def fanout(transport, **opts):
+    opts.update({"transport": transport, "screen": False})
+    return mwtffanout.FanOut(opts)
+
+
+def test_wall_time_is_set_by_the_slowest_host():
+    hosts = ["node%02d" % i for i in range(20)]
+    transport = mwtffanout.FakeTransport(
+        {host: (0, FLAGS % False, "") for host in hosts}, delay=0.2
+    )
+    start = time.monotonic()
+    report = fanout(transport, jobs=20).run(hosts, mwtffanout.FlagQuery())
+    assert time.monotonic() - start < 2
+    assert len(report.ok()) == 20
+    assert report.tally()["debug=False"] == 20
+
+
+def test_results_stream_in_completion_order():
+    def slow(cmd):
+        time.sleep(0.3)
+        return 0, FLAGS % True, ""
+
+    transport = mwtffanout.FakeTransport({"slow": slow, "fast": (0, FLAGS % False, "")})
+    seen = []
+    report = fanout(transport, jobs=2).run(
+        ["slow", "fast"], mwtffanout.FlagQuery(), seen.append
+    )
+    assert [r.host for r in seen] == ["fast", "slow"]
+    assert report.tally() == {
+        "debug=True": 1,
+        "debug=False": 1,
+        "noipv6=False": 2,
+    }
+
+
+def test_failures_are_reported():
+    transport = mwtffanout.FakeTransport(
+        {"good": (0, "[agent] runinterval = 1800\n", ""), "bad": (0, "nothing", "")}
+    )
+    runner = fanout(transport)
+    mwtf.metrics().reset()
+    report = runner.run(
+        ["good", "bad", "gone", "good"], mwtffanout.SettingQuery("runinterval")
+    )
+    assert [r.host for r in report.ok()] == ["good"]
+    assert report.ok()[0].value == "1800"
+    assert sorted(r.host for r in report.failed()) == ["bad", "gone"]
+    assert runner.errors == 2
+    lines = report.lines()
+    assert lines[0].startswith("hosts: 3 ok: 1 failed: 2")
+    assert "runinterval = 1800: 1" in lines
+    assert "failed: gone (255) ssh: Could not resolve hostname gone" in lines
+    assert len(transport.calls) == 3
+    counters, histograms = mwtf.metrics().snapshot()
+    assert counters[("wtftools_fanout_failures_total", ())] == 2
+    assert histograms[("wtftools_fanout_host_seconds", ())][0] == 3
+
+
+def test_local_transport_runs_the_command():
+    transport = mwtffanout.LocalTransport()
+    code = "print('wtfo_puppet_debug=True')"
+    assert transport.run("here", [sys.executable, "-c", code]) == (
+        0,
+        "wtfo_puppet_debug=True\n",
+        "",
+    )
+    assert transport.run("here", ["wtftools-no-such-command"])[0] == 127
+    result = transport.run(
+        "here", [sys.executable, "-c", "import time; time.sleep(5)"], 0.2
+    )
+    assert result[0] == mwtffanout.TIMEOUT_RESULT
+
+
+@pytest.mark.parametrize(
+    "query, remote",
+    [
+        (mwtffanout.FlagQuery(), "pupflag"),
+        (
+            mwtffanout.SettingQuery("server", "main main"),
+            "pupconfig -s 'main main' server",
+        ),
+    ],
+)
+def test_ssh_command(query, remote):
+    transport = mwtffanout.SshTransport(options=["StrictHostKeyChecking=no"])
+    argv = transport.command("node1", query.cmd)
+    assert argv[0] == "ssh"
+    assert argv[-3:] == ["node1", "--", remote]
+    assert "StrictHostKeyChecking=no" in argv
@@ -0,0 +1,302 @@
+import os
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+
+import mwtfmailer
+import pytest
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """Minimal SMTP server recording sessions and message bodies."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), SMTPSession)
+        self.sessions = 0
+        self.messages = []
+
+
+class SMTPSession(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.server.sessions += 1
+        self.reply("220 stand-in ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb = line.split()[0].upper() if line.strip() else b""
+            if verb in (b"EHLO", b"HELO"):
+                self.reply("250 stand-in")
+            elif verb == b"DATA":
+                self.reply("354 go ahead")
+                data = []
+                for chunk in iter(self.rfile.readline, b""):
+                    if chunk == b".\r\n":
+                        break
+                    data.append(chunk)
+                self.server.messages.append(b"".join(data).decode())
+                self.reply("250 queued")
+            elif verb == b"QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 ok")
+
+
+@pytest.fixture
+def server():
+    server = SMTPStandIn()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    mwtfmailer.close_pools()
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def make_mailer(server):
+    return mwtfmailer.Mailer(
+        {
+            "transport": "smtp",
+            "smtp_host": "127.0.0.1",
+            "smtp_port": server.server_address[1],
+        }
+    )
+
+
+def test_smtp_reuses_one_session(server):
+    mailer = make_mailer(server)
+    for i in range(5):
+        assert mailer.send({"to": "ops", "subject": "alert %d" % i}, "body") == 0
+    assert make_mailer(server).send({"to": "ops"}, "another") == 0
+    assert server.sessions == 1
+    assert len(server.messages) == 6
+    assert "Subject: alert 0" in server.messages[0]
+
+
+def test_flush_digest_per_recipient(server):
+    mailer = make_mailer(server)
+    for i in range(3):
+        mailer.queue({"to": "ops", "subject": "disk %d" % i}, "disk %d full" % i)
+    mailer.queue({"to": "dev", "subject": "build"}, "build broke")
+    assert mailer.flush(digest=True) == 0
+    assert mailer.pending == []
+    assert len(server.messages) == 2
+    assert "Subject: Digest of 3 messages" in server.messages[0]
+    assert "disk 2 full" in server.messages[0]
+    assert "Subject: build" in server.messages[1]
+
+
+class ResetSession:
+    """Pooled session whose socket the server has reset."""
+
+    def noop(self):
+        raise BrokenPipeError(32, "Broken pipe")
+
+    def send_message(self, msg):
+        raise ConnectionResetError(104, "Connection reset by peer")
+
+    def close(self):
+        pass
+
+
+def test_smtp_reconnects_after_a_reset(server):
+    mailer = make_mailer(server)
+    pool = mwtfmailer.smtp_pool("127.0.0.1", server.server_address[1])
+    pool.smtp = ResetSession()
+    pool.used = time.monotonic()
+    assert mailer.send({"to": "ops"}, "after reset") == 0
+    pool.smtp = ResetSession()
+    pool.used = 0
+    assert mailer.send({"to": "ops"}, "after idle") == 0
+    assert server.sessions == 2
+    assert len(server.messages) == 2
+
+
+def test_smtp_pool_per_login_and_settings():
+    pool = mwtfmailer.smtp_pool("mail", 25, "ops", "old")
+    assert mwtfmailer.smtp_pool("mail", 25, "ops", "old") is pool
+    assert mwtfmailer.smtp_pool("mail", 25, "ops", "new") is not pool
+    assert mwtfmailer.smtp_pool("mail", 25, "ops", "old", True) is not pool
+    assert mwtfmailer.smtp_pool("mail", 25, "ops", "old", timeout=5) is not pool
+
+
+def test_smtp_pool_is_shared_between_threads(server):
+    mailer = make_mailer(server)
+
+    def send(i):
+        for j in range(5):
+            assert mailer.send({"to": "ops"}, "thread %d message %d" % (i, j)) == 0
+
+    threads = [threading.Thread(target=send, args=(i,), daemon=True) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+        assert not thread.is_alive()
+    assert server.sessions == 1
+    assert len(server.messages) == 40
+
+
+def test_smtp_failure_is_reported(capsys):
+    mailer = mwtfmailer.Mailer(
+        {"transport": "smtp", "smtp_host": "127.0.0.1", "smtp_port": 1}
+    )
+    assert mailer.send({"to": "ops"}, "body") == 1
+    assert "smtp delivery failed" in capsys.readouterr().out
+
+
+class FlakyMailer(mwtfmailer.Mailer):
+    def __init__(self, opts, failures=0, error=None):
+        super().__init__(opts)
+        self.failures = failures
+        self.error = error
+        self.delivered = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def deliver(self, args, body):
+        self.gate.wait()
+        if self.failures:
+            self.failures -= 1
+            if self.error is not None:
+                raise self.error
+            return 75
+        self.delivered.append(body)
+        return 0
+
+
+def spool_opts(tmp_path, **opts):
+    options = {"spool": str(tmp_path / "spool"), "spool_backoff": 0.01}
+    options.update(opts)
+    return options
+
+
+def test_send_returns_a_handle_immediately(tmp_path):
+    mailer = FlakyMailer(spool_opts(tmp_path))
+    mailer.gate.clear()
+    delivery = mailer.send({"to": "ops"}, "hello")
+    assert isinstance(delivery, mwtfmailer.Delivery)
+    assert not delivery.done()
+    assert len(list((tmp_path / "spool").glob("*.json"))) == 1
+    mailer.gate.set()
+    assert delivery.wait(5) == 0
+    assert mailer.delivered == ["hello"]
+    assert list((tmp_path / "spool").glob("*.json")) == []
+
+
+def test_retry_with_backoff_then_give_up(tmp_path):
+    mailer = FlakyMailer(spool_opts(tmp_path), failures=2)
+    delivery = mailer.send({"to": "ops"}, "retried")
+    assert delivery.wait(5) == 0
+    assert delivery.attempts == 2
+
+    mailer = FlakyMailer(spool_opts(tmp_path, spool=str(tmp_path / "b")), 10)
+    mailer.options["spool_retries"] = 1
+    delivery = mailer.send({"to": "ops"}, "lost")
+    assert delivery.wait(5) == 75
+    assert len(list((tmp_path / "b" / "failed").glob("*.json"))) == 1
+
+
+def test_spooled_messages_survive_a_restart(tmp_path):
+    spool = tmp_path / "crashed"
+    spool.mkdir()
+    (spool / "1-left.json").write_text(
+        '{"args": {"to": "ops"}, "body": "left over", "attempts": 1}'
+    )
+    mailer = FlakyMailer(spool_opts(tmp_path, spool=str(spool)))
+    queue = mailer.spool_queue()
+    assert queue.drain(5)
+    assert mailer.delivered == ["left over"]
+
+
+def test_transport_errors_are_retried(tmp_path):
+    error = FileNotFoundError(2, "No such file or directory", "/usr/sbin/sendmail")
+    mailer = FlakyMailer(spool_opts(tmp_path), failures=2, error=error)
+    delivery = mailer.send({"to": "ops"}, "retried")
+    assert delivery.wait(5) == 0
+    assert delivery.attempts == 2
+    assert not (tmp_path / "spool" / "failed").exists()
+
+
+def test_unreadable_message_does_not_stop_the_queue(tmp_path, monkeypatch):
+    spool = tmp_path / "spool"
+    spool.mkdir()
+    (spool / "1-broken.json").write_text("{not json")
+    mailer = FlakyMailer(spool_opts(tmp_path), failures=1)
+    mailer.gate.clear()
+    delivery = mailer.send({"to": "ops"}, "first")
+
+    def broken_fsync(fd):
+        raise OSError(5, "Input/output error")
+
+    monkeypatch.setattr(mwtfmailer.os, "fsync", broken_fsync)
+    mailer.gate.set()
+    assert delivery.wait(5) == 1
+    monkeypatch.undo()
+    assert mailer.send({"to": "ops"}, "second").wait(5) == 0
+    assert mailer.delivered == ["second"]
+    assert os.listdir(str(spool / "failed")) == ["1-broken.json"]
+
+
+def test_each_message_uses_its_own_mailer(tmp_path):
+    first = FlakyMailer(spool_opts(tmp_path))
+    second = FlakyMailer(spool_opts(tmp_path, transport="smtp"))
+    assert first.send({"to": "ops"}, "one").wait(5) == 0
+    assert second.send({"to": "ops"}, "two").wait(5) == 0
+    assert first.delivered == ["one"]
+    assert second.delivered == ["two"]
+
+
+def test_shared_spool_delivers_once(tmp_path):
+    spool = tmp_path / "shared"
+    spool.mkdir()
+    (spool / "1-shared.json").write_text(
+        '{"args": {"to": "ops"}, "body": "once", "attempts": 0}'
+    )
+    mailers = [FlakyMailer(spool_opts(tmp_path)) for i in range(2)]
+    for mailer in mailers:
+        mailer.gate.clear()
+    queues = [mwtfmailer.SpoolQueue(mailer, str(spool)) for mailer in mailers]
+    for mailer in mailers:
+        mailer.gate.set()
+    assert all(queue.drain(5) for queue in queues)
+    assert mailers[0].delivered + mailers[1].delivered == ["once"]
+    assert not (spool / "1-shared.json").exists()
+
+
+EXITING = """
+import sys, time, mwtfmailer
+
+class SlowMailer(mwtfmailer.Mailer):
+    def deliver(self, args, body):
+        time.sleep(0.3)
+        with open(sys.argv[2], "a") as f:
+            f.write(body)
+        return 0
+
+SlowMailer({"spool": sys.argv[1]}).send({"to": "ops"}, "sent at exit")
+"""
+
+
+def test_spool_is_drained_at_exit(tmp_path):
+    wtftools = os.path.join(os.path.dirname(os.path.dirname(__file__)), "wtftools")
+    spool = tmp_path / "spool"
+    sent = tmp_path / "sent"
+    subprocess.run(
+        [sys.executable, "-c", EXITING, str(spool), str(sent)],
+        cwd=wtftools,
+        check=True,
+        timeout=30,
+    )
+    assert sent.read_text() == "sent at exit"
+    assert list(spool.glob("*.json")) == []
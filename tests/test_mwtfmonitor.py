@@ -0,0 +1,142 @@
+import os
+import threading
+
+import mwtfalertable
+import mwtfmonitor
+import mwtfpuppet
+import pytest
+
+SUMMARY = "---\ntime:\n  last_run: %d\n"
+
+
+class RecordingSink:
+    def __init__(self):
+        self.events = []
+
+    def raise_alert(self, alerter, alert):
+        self.events.append(("raise", alert["key"]))
+
+    def clear_alert(self, alerter, alert):
+        self.events.append(("clear", alert["key"]))
+
+
+@pytest.fixture
+def monitor(tmp_path, monkeypatch):
+    def make(conf=None, **opts):
+        options = {
+            "alert_sink": RecordingSink(),
+            "alert_state": str(tmp_path / "alerts.json"),
+            "caller": "test",
+            "logfile": str(tmp_path / "log"),
+            "screen": False,
+            "poll_interval": 30,
+        }
+        options.update(opts)
+        monitor = mwtfmonitor.PuppetMonitor(options)
+        monitor.lastrun = str(tmp_path / "last_run_summary.yaml")
+        if conf is None:
+            monkeypatch.setattr(monitor, "_run_interval", lambda: 100)
+        else:
+            pathname = tmp_path / "puppet.conf"
+            pathname.write_text(conf)
+            monitor.pathnames["config"] = {"pn": str(pathname), "status": "good"}
+        return monitor
+
+    mwtfalertable.__BUCKETS__.pop(mwtfmonitor.PuppetMonitor.ALERT_KEY, None)
+    yield make
+    mwtfalertable.__BUCKETS__.pop(mwtfmonitor.PuppetMonitor.ALERT_KEY, None)
+    mwtfpuppet.forget_settings()
+
+
+def write_summary(monitor, last_run):
+    replacement = monitor.lastrun + ".new"
+    with open(replacement, "w") as f:
+        f.write(SUMMARY % last_run)
+    os.rename(replacement, monitor.lastrun)
+
+
+def test_check_transitions(monitor):
+    monitor = monitor(alert_burst=10)
+    key = monitor.ALERT_KEY
+    assert monitor.check(1000) is None
+    assert monitor.stale is True
+
+    write_summary(monitor, 1000)
+    assert monitor.check(1050) == 151
+    assert monitor.stale is False
+    assert monitor.check(1150) == 51
+    assert monitor.check(1201) is None
+    assert monitor.stale is True
+    assert monitor.sink.events == [("raise", key), ("clear", key), ("raise", key)]
+
+
+def test_rate_limited_transition_is_retried(monitor, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(mwtfalertable.time, "monotonic", lambda: now[0])
+    monitor = monitor(alert_rate=0.01, alert_burst=1)
+    key = monitor.ALERT_KEY
+    assert monitor.check(1000) is None
+    write_summary(monitor, 1000)
+    assert monitor.check(1010) == 30
+    assert monitor.stale is True
+    assert monitor.sink.events == [("raise", key)]
+
+    now[0] += 100
+    assert monitor.check(1040) == 161
+    assert monitor.stale is False
+    assert monitor.sink.events == [("raise", key), ("clear", key)]
+
+
+@pytest.mark.parametrize(
+    "conf, interval",
+    [
+        ("[main]\nserver = puppet.example.com\n", 1800),
+        ("[agent]\nruninterval = 30m\n", 1800),
+        ("[agent]\nruninterval = 1h\n", 3600),
+        ("[main]\nruninterval = 600\n[agent]\nserver = puppet\n", 600),
+        ("[main]\nruninterval = 1d\n[agent]\nruninterval = 90s\n", 90),
+        ("[agent]\nruninterval = soon\n", 1800),
+    ],
+)
+def test_run_interval_from_puppet_conf(monitor, conf, interval):
+    monitor = monitor(conf)
+    assert monitor.threshold() == interval * 2
+    write_summary(monitor, 1000)
+    assert monitor.check(1010) == interval * 2 - 9
+    assert monitor.stale is False
+
+
+def test_inotify_watcher(tmp_path):
+    directory = tmp_path / "state"
+    directory.mkdir()
+    pathname = directory / "last_run_summary.yaml"
+    try:
+        watcher = mwtfmonitor.InotifyWatcher(str(pathname))
+    except (OSError, AttributeError) as ex:
+        pytest.skip("inotify unavailable: %s" % ex)
+    try:
+        assert not watcher.wait(0.05)
+        (directory / "other.yaml").write_text("")
+        assert not watcher.wait(0.05)
+        timer = threading.Timer(0.1, pathname.write_text, ["---\n"])
+        timer.start()
+        assert watcher.wait(5)
+        timer.join()
+        (directory / "other.yaml").unlink()
+        pathname.unlink()
+        directory.rmdir()
+        with pytest.raises(FileNotFoundError):
+            watcher.wait(5)
+    finally:
+        watcher.close()
+
+
+def test_poll_watcher(tmp_path):
+    pathname = tmp_path / "last_run_summary.yaml"
+    watcher = mwtfmonitor.PollWatcher(str(pathname), interval=0.01)
+    assert not watcher.wait(0.05)
+    pathname.write_text("---\n")
+    assert watcher.wait(5)
+    assert not watcher.wait(0.05)
+    pathname.unlink()
+    assert watcher.wait(5)
@@ -0,0 +1,102 @@
+import os
+import time
+
+import mwtfpuppet
+import pytest
+
+
+@pytest.fixture
+def flagger(tmp_path):
+    return mwtfpuppet.PuppetFlags(
+        {
+            "flagdir": str(tmp_path / "flags"),
+            "caller": "test",
+            "logfile": str(tmp_path / "log"),
+            "screen": False,
+            "set": None,
+            "clear": None,
+        }
+    )
+
+
+def test_snapshot_without_directory(flagger):
+    snapshot = flagger.snapshot()
+    assert set(snapshot) == set(flagger.flags())
+    assert not any(state.state for state in snapshot.values())
+    with pytest.raises(TypeError):
+        snapshot["debug"] = mwtfpuppet.FlagState(True, 0)
+
+
+def test_apply_batch(flagger):
+    states, results = flagger.apply(
+        [("debug", True), ("stopped", True), ("bogus", True), ("stopped", False)]
+    )
+    assert results == {"bogus": "invalid", "debug": "set", "stopped": "unchanged"}
+    assert states["debug"].state and not states["stopped"].state
+    assert os.path.exists(flagger.flag_fpn("debug"))
+    assert flagger.snapshot()["debug"].mtime == states["debug"].mtime
+
+    states, results = flagger.apply([("debug", False), ("nowarn", True)])
+    assert results == {"debug": "cleared", "nowarn": "set"}
+    assert not os.path.exists(flagger.flag_fpn("debug"))
+
+
+def test_apply_rolls_back_on_failure(flagger, monkeypatch):
+    real_open = os.open
+
+    def failing_open(path, *args):
+        if path.endswith("stopped.puppet"):
+            raise PermissionError("denied")
+        return real_open(path, *args)
+
+    monkeypatch.setattr(os, "open", failing_open)
+    states, results = flagger.apply([("debug", True), ("stopped", True)])
+    assert results == {"debug": "rolled back", "stopped": "failed"}
+    monkeypatch.undo()
+    assert not any(state.state for state in flagger.snapshot().values())
+
+
+def test_cli_run(flagger, capsys):
+    flagger.options.update({"set": ["noipv6", "bogus"], "clear": ["debug"]})
+    assert flagger.cli_run() == 1
+    out = capsys.readouterr().out
+    assert "wtfo_puppet_noipv6=True" in out
+    assert "wtfo_puppet_debug=False" in out
+
+
+def test_load_settings_reloads_on_change(tmp_path):
+    conf = tmp_path / "puppet.conf"
+    conf.write_text("[main]\nvardir = /var/lib/puppet\nratio = 50%\n[agent]\n")
+    first = mwtfpuppet.load_settings(str(conf))
+    assert first["main"] == {"vardir": "/var/lib/puppet", "ratio": "50%"}
+    assert mwtfpuppet.load_settings(str(conf)) is first
+
+    conf.write_text("[agent]\nruninterval = 1800\n")
+    later = time.time() + 10
+    os.utime(conf, (later, later))
+    assert mwtfpuppet.load_settings(str(conf))["agent"] == {"runinterval": "1800"}
+
+
+def test_pathname_alerts_once(tmp_path):
+    events = []
+
+    class Sink:
+        def raise_alert(self, alerter, alert):
+            events.append(alert["key"])
+
+        def clear_alert(self, alerter, alert):
+            events.append("clear " + alert["key"])
+
+    config = mwtfpuppet.PuppetConfig(
+        {
+            "alert_sink": Sink(),
+            "alert_state": str(tmp_path / "alerts.json"),
+            "caller": "test",
+            "logfile": str(tmp_path / "log"),
+            "screen": False,
+        }
+    )
+    config.pathnames["config"] = {"pn": None, "status": "File not found."}
+    for i in range(1000):
+        assert config.pathname("config") is None
+    assert events == ["puppet.config.file.status"]
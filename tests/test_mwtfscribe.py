@@ -0,0 +1,162 @@
+import json
+import logging
+import queue
+import time
+
+import mwtfscribe
+import mwtfsinks
+import pytest
+
+
+@pytest.fixture
+def wtfo():
+    mwtfscribe.reset_sinks()
+    yield logging.getLogger("wtfo")
+    mwtfscribe.reset_sinks()
+
+
+def test_queued_scribe_writes_everything_on_flush(tmp_path, wtfo):
+    logfile = tmp_path / "queued.log"
+    scribe = mwtfscribe.Scribe(
+        {
+            "caller": "test",
+            "logfile": str(logfile),
+            "screen": False,
+            "queued": True,
+            "overflow": "block",
+            "queue_size": 10,
+        }
+    )
+    for i in range(500):
+        scribe.warn("record %d", i)
+    scribe.flush()
+    lines = logfile.read_text().splitlines()
+    assert len(lines) == 500
+    assert lines[-1].endswith(" - record 499")
+
+
+@pytest.mark.parametrize(
+    "policy, kept", [("drop", ["0", "1"]), ("drop_oldest", ["2", "3"])]
+)
+def test_overflow_policies(policy, kept):
+    records = queue.Queue(2)
+    handler = mwtfsinks.BoundedQueueHandler(records, policy)
+    for i in range(4):
+        handler.handle(logging.makeLogRecord({"msg": str(i)}))
+    assert handler.dropped == 2
+    assert [records.get_nowait().msg for i in range(2)] == kept
+
+
+def per_record_cost(scribe, records=2000):
+    start = time.perf_counter()
+    for i in range(records):
+        scribe.warn("record %d", i)
+    return (time.perf_counter() - start) / records
+
+
+def test_handlers_are_configured_once(tmp_path, wtfo):
+    opts = {"caller": "test", "logfile": str(tmp_path / "one.log"), "screen": False}
+    first = mwtfscribe.Scribe(opts)
+    baseline = per_record_cost(first)
+    handlers = list(wtfo.handlers)
+
+    scribes = [mwtfscribe.Scribe(opts) for i in range(200)]
+    assert wtfo.handlers == handlers
+    assert scribes[-1].sinks is first.sinks
+    # per record cost must not grow with the number of instances
+    assert per_record_cost(scribes[-1]) < baseline * 3
+
+    scribes[0].warn("marker")
+    log = (tmp_path / "one.log").read_text()
+    assert log.count("marker") == 1
+
+
+def test_reconfiguration_replaces_handlers(tmp_path, wtfo):
+    opts = {"caller": "test", "logfile": str(tmp_path / "a.log"), "screen": False}
+    mwtfscribe.Scribe(opts)
+    opts["logfile"] = str(tmp_path / "b.log")
+    scribe = mwtfscribe.Scribe(opts)
+    assert len(wtfo.handlers) == 1
+    scribe.warn("moved")
+    assert not (tmp_path / "a.log").exists()
+    assert "moved" in (tmp_path / "b.log").read_text()
+
+
+@pytest.mark.parametrize("queued", [False, True])
+def test_json_format(tmp_path, wtfo, queued):
+    logfile = tmp_path / "json.log"
+    scribe = mwtfscribe.Scribe(
+        {
+            "caller": "pupflag",
+            "logfile": str(logfile),
+            "screen": False,
+            "format": "json",
+            "queued": queued,
+        }
+    )
+    scribe.debug("filtered %s", "out")
+    scribe.warn("flag %s set", "debug", extra={"flag": "debug"})
+    scribe.flush()
+    lines = logfile.read_text().splitlines()
+    assert len(lines) == 1
+    record = json.loads(lines[0])
+    assert record["message"] == "flag debug set"
+    assert record["caller"] == "pupflag"
+    assert record["level"] == "WARNING"
+    assert record["flag"] == "debug"
+    assert record["host"]
+
+
+def test_queued_json_keeps_the_exception(tmp_path, wtfo):
+    logfile = tmp_path / "json.log"
+    scribe = mwtfscribe.Scribe(
+        {
+            "caller": "pupflag",
+            "logfile": str(logfile),
+            "screen": False,
+            "format": "json",
+            "queued": True,
+        }
+    )
+    try:
+        raise ValueError("bad flag")
+    except ValueError:
+        scribe.error("flag %s failed", "debug", exc_info=True, extra={"flag": "x"})
+    scribe.flush()
+    record = json.loads(logfile.read_text())
+    assert record["message"] == "flag debug failed"
+    assert record["flag"] == "x"
+    assert record["exception"].startswith("Traceback")
+    assert "ValueError: bad flag" in record["exception"]
+
+
+def test_json_formatter_is_not_called_for_filtered_records(tmp_path, wtfo):
+    scribe = mwtfscribe.Scribe(
+        {
+            "caller": "t",
+            "logfile": str(tmp_path / "x"),
+            "screen": False,
+            "format": "json",
+        }
+    )
+    calls = []
+    formatter = scribe.sinks.realize()[0].formatter
+    formatter.format = lambda record: calls.append(record) or ""
+    for i in range(100):
+        scribe.info("not logged at warning level")
+    assert calls == []
+
+
+def test_sinks_are_built_for_the_first_record(tmp_path, wtfo):
+    logfile = tmp_path / "lazy.log"
+    scribe = mwtfscribe.Scribe(
+        {"caller": "t", "logfile": str(logfile), "screen": False}
+    )
+    scribe.info("below the level")
+    assert not logfile.exists()
+    assert scribe.sinks.handlers == []
+    scribe.warn("first")
+    scribe.warn("second")
+    assert isinstance(wtfo.handlers[0], logging.FileHandler)
+    assert len(wtfo.handlers) == 1
+    assert logfile.read_text().count(" - ") == 2
@@ -0,0 +1,83 @@
+import os
+
+import mwtf
+import mwtfsummary
+import pytest
+
+SUMMARY = """---
+version:
+  config: 1665912345
+  puppet: 7.20.0
+resources:
+  changed: 2
+  corrective_change: 0
+  failed: 1
+  failed_to_restart: 0
+  out_of_sync: 2
+  restarted: 0
+  scheduled: 0
+  skipped: 0
+  total: 312
+time:
+  file: 0.41
+  total: 14.27
+  last_run: 1665912400
+changes:
+  total: 2
+events:
+  failure: 1
+  success: 1
+  total: 2
+"""
+
+
+@pytest.fixture
+def summary_file(tmp_path):
+    path = tmp_path / "last_run_summary.yaml"
+    path.write_text(SUMMARY)
+    yield str(path)
+    mwtfsummary.forget()
+
+
+def test_accessors(summary_file):
+    summary = mwtfsummary.load(summary_file)
+    assert summary.last_run() == 1665912400
+    assert summary.run_time() == pytest.approx(14.27)
+    assert summary.resource_count() == 312
+    assert summary.resources()["changed"] == 2
+    assert summary.changes() == 2
+    assert summary.failures() == 1
+    assert summary.failed_events() == 1
+    assert summary.failed()
+    assert summary.puppet_version() == "7.20.0"
+    assert summary.age(1665912460) == 60
+
+
+def test_cached_until_file_changes(summary_file, monkeypatch):
+    first = mwtfsummary.load(summary_file)
+    calls = []
+    real = mwtf.load_yaml
+    monkeypatch.setattr(
+        mwtf, "load_yaml", lambda *args: calls.append(args) or real(*args)
+    )
+    assert mwtfsummary.load(summary_file) is first
+    assert calls == []
+
+    replacement = summary_file + ".new"
+    with open(replacement, "w") as f:
+        f.write(SUMMARY.replace("failed: 1", "failed: 0"))
+    os.rename(replacement, summary_file)
+    second = mwtfsummary.load(summary_file)
+    assert len(calls) == 1
+    assert second is not first
+    assert second.failed_resources() == 0
+    assert second.failures() == 0
+    assert second.failed()
+
+
+def test_empty_summary(tmp_path):
+    path = tmp_path / "last_run_summary.yaml"
+    path.write_text("")
+    summary = mwtfsummary.load(str(path))
+    assert summary.failed()
+    assert summary.run_time() == 0.0
@@ -0,0 +1,92 @@
+import os
+import subprocess
+
+import pkgindex
+import pkgmgrs
+
+
+class FakeHandler(pkgmgrs.PackageHandler):
+    def __init__(self, dbfile, opts={}):
+        super().__init__(opts)
+        self.dbfile = dbfile
+        self.installed = {
+            "bash": pkgmgrs.PackageRecord("bash", "5.2", "1", "x86_64"),
+            "zsh": pkgmgrs.PackageRecord("zsh", "5.9", "1", "x86_64"),
+        }
+        self.files = {"bash": ["/usr/bin/bash", "/etc/skel"], "zsh": ["/usr/bin/zsh"]}
+        self.queried = []
+
+    def db_path(self):
+        return self.dbfile
+
+    def iter_installed(self):
+        return iter(list(self.installed.values()))
+
+    def iter_files(self, names):
+        self.queried.append(list(names))
+        for name in names:
+            for path in self.files[name]:
+                yield name, path
+
+    def change(self, mtime):
+        os.utime(self.dbfile, (mtime, mtime))
+
+
+def test_index_lookups_and_incremental_refresh(tmp_path):
+    dbfile = tmp_path / "status"
+    dbfile.write_text("")
+    handler = FakeHandler(str(dbfile), {"index": True, "index_dir": str(tmp_path)})
+    index = handler.index()
+
+    assert index.owners("/usr/bin/zsh") == ["zsh"]
+    assert index.files("bash") == ["/etc/skel", "/usr/bin/bash"]
+    assert handler.queried == [["bash", "zsh"]]
+
+    # unchanged database, no backend queries
+    assert handler.file_batch(["/usr/bin/bash", "/nope"]) == {
+        "/usr/bin/bash": ["bash"],
+        "/nope": None,
+    }
+    assert len(handler.queried) == 1
+
+    # upgrade zsh, only zsh is re-read
+    handler.installed["zsh"] = pkgmgrs.PackageRecord("zsh", "5.9", "2", "x86_64")
+    handler.files["zsh"] = ["/usr/bin/zsh", "/usr/bin/zsh-5.9"]
+    handler.change(1000)
+    assert index.owners("/usr/bin/zsh-5.9") == ["zsh"]
+    assert handler.queried[-1] == ["zsh"]
+    assert [row[2] for row in index.packages()] == ["1", "2"]
+
+    # remove bash
+    del handler.installed["bash"]
+    handler.change(2000)
+    assert index.owners("/usr/bin/bash") == []
+    assert [row[0] for row in index.packages()] == ["zsh"]
+
+
+class FakeDnfHandler(FakeHandler, pkgmgrs.DnfHandler):
+    pass
+
+
+def test_rpm_file_action_uses_the_index(tmp_path, monkeypatch, capsys):
+    def forbidden(*args, **kwargs):
+        raise AssertionError("ran a backend command: %s" % (args,))
+
+    monkeypatch.setattr(subprocess, "run", forbidden)
+    monkeypatch.setattr(subprocess, "Popen", forbidden)
+    dbfile = tmp_path / "rpmdb.sqlite"
+    dbfile.write_text("")
+    handler = FakeDnfHandler(str(dbfile), {"index": True, "index_dir": str(tmp_path)})
+    assert handler.action("file", ["/usr/bin/zsh"]) == 0
+    assert handler.action("file", ["/usr/bin/bash", "/nope"]) == 1
+    out = capsys.readouterr().out
+    assert "/usr/bin/zsh: zsh\n" in out
+    assert "/usr/bin/bash: bash\n/nope: not found\n" in out
+
+
+def test_db_stamp_tracks_directory_entries(tmp_path):
+    (tmp_path / "Packages").write_text("")
+    first = pkgindex.db_stamp(str(tmp_path))
+    os.utime(tmp_path / "Packages", (4000000000, 4000000000))
+    assert pkgindex.db_stamp(str(tmp_path)) != first
+    assert pkgindex.db_stamp(str(tmp_path / "missing")) is None
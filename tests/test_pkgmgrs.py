@@ -0,0 +1,342 @@
+import asyncio
+import os
+import sys
+import time
+
+import mwtf
+import pkgcache
+import pkgmgrs
+import pytest
+
+
+def test_execute_many_keeps_order_and_runs_concurrently():
+    handler = pkgmgrs.PackageHandler({"jobs": 4})
+    items = ["a", "b", "c", "d"]
+    script = "import sys, time; time.sleep(0.2); print(sys.argv[1])"
+    start = time.monotonic()
+    results = handler.execute_many([[sys.executable, "-c", script, i] for i in items])
+    elapsed = time.monotonic() - start
+    assert [r.stdout.strip() for r in results] == items
+    assert all(r.returncode == 0 for r in results)
+    assert elapsed < 0.2 * len(items)
+
+
+def test_capture_missing_binary():
+    result = pkgmgrs.PackageHandler().capture(["/nonexistent/wtftools-binary"])
+    assert result.returncode == 1
+    assert result.stderr
+
+
+def test_chunk_args_respects_batch_size():
+    handler = pkgmgrs.PackageHandler({"batch_size": 2})
+    chunks = list(handler.chunk_args(["rpm", "-qf"], ["a", "b", "c", "d", "e"]))
+    assert chunks == [["a", "b"], ["c", "d"], ["e"]]
+
+
+def test_chunk_args_respects_argv_budget(monkeypatch):
+    handler = pkgmgrs.PackageHandler()
+    monkeypatch.setattr(handler, "arg_budget", lambda: 100)
+    items = ["/usr/lib/%020d" % i for i in range(10)]
+    chunks = list(handler.chunk_args(["dpkg", "-S"], items))
+    assert [item for chunk in chunks for item in chunk] == items
+    assert all(len(chunk) == 2 for chunk in chunks)
+
+
+def test_yum_file_batch_splits_on_sentinel():
+    handler = pkgmgrs.YumHandler()
+    handler.sentinel = "/tmp/wtftools-sentinel-x"
+    not_owned = "file /tmp/wtftools-sentinel-x is not owned by any package"
+    stdout = "\n".join(
+        ["bash", not_owned, "file /opt/x is not owned by any package", not_owned]
+        + ["filesystem", "setup", not_owned]
+    )
+    items = ["/usr/bin/bash", "/opt/x", "/etc"]
+    result = pkgmgrs.CommandResult(0, stdout + "\n", "")
+    assert handler.parse_file_batch(items, result) == {
+        "/usr/bin/bash": ["bash"],
+        "/opt/x": [],
+        "/etc": ["filesystem", "setup"],
+    }
+
+
+def test_yum_info_batch_skips_missing_packages():
+    handler = pkgmgrs.YumHandler()
+    handler.sentinel = "wtftools-sentinel-x"
+    not_installed = "package wtftools-sentinel-x is not installed"
+    stdout = "\n".join(
+        ["Name        : bash", "Version     : 5.2", not_installed]
+        + ["package nope is not installed", not_installed]
+    )
+    found = handler.parse_info_batch(
+        ["bash", "nope"], pkgmgrs.CommandResult(1, stdout, "")
+    )
+    assert list(found) == ["bash"]
+    assert found["bash"].startswith("Name        : bash")
+
+
+def test_pacman_batch_parsers():
+    handler = pkgmgrs.PacmanHandler()
+    result = pkgmgrs.CommandResult(0, "/usr/bin/ls is owned by coreutils 9.1-1\n", "")
+    assert handler.parse_file_batch(["/usr/bin/ls"], result) == {
+        "/usr/bin/ls": ["coreutils"]
+    }
+    stdout = "Name            : bash\nVersion         : 5.1\n\nName            : zsh\n"
+    found = handler.parse_info_batch(
+        ["bash", "zsh"], pkgmgrs.CommandResult(0, stdout, "")
+    )
+    assert found["bash"].endswith("5.1")
+    assert "zsh" in found
+
+
+class LocaleHandler(pkgmgrs.PackageHandler):
+    def file_batch_cmd(self, items):
+        script = "import os, sys; print(os.environ['LC_ALL'], *sys.argv[1:])"
+        return [sys.executable, "-c", script] + items
+
+    def parse_file_batch(self, items, result):
+        return {item: result.stdout.split()[:1] for item in items}
+
+
+def test_batch_runs_in_the_c_locale(monkeypatch):
+    monkeypatch.setenv("LC_ALL", "de_DE.UTF-8")
+    handler = LocaleHandler({"batch_size": 1})
+    assert handler.file_batch(["/a", "/b"]) == {"/a": ["C"], "/b": ["C"]}
+    assert os.environ["LC_ALL"] == "de_DE.UTF-8"
+
+
+class FakeRpmHandler(pkgmgrs.YumHandler):
+    def stream(self, cmd):
+        assert cmd[:2] == ["rpm", "-qa"]
+        yield "zlib\t1.2.13\t3.fc38\tx86_64"
+        yield "bash\t5.2.15\t3.fc38\tx86_64"
+
+
+def test_iter_installed_and_render(tmp_path, capsys):
+    handler = FakeRpmHandler({"output": str(tmp_path / "pkgs"), "quiet": False})
+    records = list(handler.iter_installed())
+    assert records[1] == pkgmgrs.PackageRecord("bash", "5.2.15", "3.fc38", "x86_64")
+    assert handler.list_packages() == 0
+    expected = "bash-5.2.15-3.fc38.x86_64.rpm\nzlib-1.2.13-3.fc38.x86_64.rpm\n"
+    assert capsys.readouterr().out == expected
+    assert (tmp_path / "pkgs").read_text() == expected
+
+
+def test_stream_stops_early_without_error():
+    handler = pkgmgrs.PackageHandler()
+    script = "import sys\nfor i in range(100000): print(i)"
+    lines = handler.stream([sys.executable, "-c", script])
+    assert next(lines) == "0"
+    lines.close()
+    assert handler.errors == 0
+
+
+def test_stream_missing_binary(capsys):
+    handler = pkgmgrs.PackageHandler()
+    assert handler.render(handler.stream(["/nonexistent/wtftools-binary"])) == 1
+    assert "wtftools-binary" in capsys.readouterr().out
+    assert handler.errors == 1
+    assert handler.render(iter(["ok"])) == 0
+
+
+def test_split_release():
+    assert pkgmgrs.split_release("1:2.3-4") == ("1:2.3", "4")
+    assert pkgmgrs.split_release("3.134") == ("3.134", "")
+
+
+DPKG_STATUS = """Package: bash
+Essential: yes
+Status: install ok installed
+Architecture: amd64
+Version: 5.2.15-2+b2
+Description: GNU Bourne Again SHell
+ Bash is an sh-compatible command language interpreter.
+
+Package: libc6
+Status: install ok installed
+Architecture: amd64
+Multi-Arch: same
+Version: 2.36-9
+
+Package: removed
+Status: deinstall ok config-files
+Architecture: all
+Version: 1.0
+"""
+
+
+def test_apt_reads_dpkg_database(tmp_path, capsys):
+    (tmp_path / "status").write_text(DPKG_STATUS)
+    info = tmp_path / "info"
+    info.mkdir()
+    (info / "bash.list").write_text("/bin/bash\n/etc/bash.bashrc\n")
+    (info / "libc6:amd64.list").write_text("/lib/x86_64-linux-gnu/libc.so.6\n")
+    handler = pkgmgrs.AptHandler()
+    handler.status = str(tmp_path / "status")
+    handler.infodir = str(info)
+
+    assert list(handler.iter_installed()) == [
+        pkgmgrs.PackageRecord("bash", "5.2.15", "2+b2", "amd64"),
+        pkgmgrs.PackageRecord("libc6", "2.36", "9", "amd64"),
+    ]
+    assert list(handler.iter_files(["libc6"])) == [
+        ("libc6", "/lib/x86_64-linux-gnu/libc.so.6")
+    ]
+    assert handler.list_package(["bash"]) == 0
+    assert capsys.readouterr().out == "/bin/bash\n/etc/bash.bashrc\n"
+    assert handler.list_package(["removed"]) == 1
+
+
+def test_detect_backend_uses_os_release_and_cache(tmp_path, monkeypatch):
+    release = tmp_path / "os-release"
+    release.write_text('NAME="Rocky Linux"\nID="rocky"\nID_LIKE="rhel centos fedora"\n')
+    monkeypatch.setattr(pkgmgrs, "OS_RELEASE", [str(release)])
+    probes = []
+    available = {"dnf", "rpm", "dpkg"}
+
+    def which(name):
+        probes.append(name)
+        return sys.executable if name in available else None
+
+    monkeypatch.setattr(pkgmgrs.shutil, "which", which)
+    cache = str(tmp_path / "backend.json")
+    assert pkgmgrs.detect_backend(cache) == "dnf"
+    count = len(probes)
+    handler = pkgmgrs.create_handler({}, cache_file=cache)
+    assert isinstance(handler, pkgmgrs.DnfHandler)
+    assert len(probes) == count
+
+    release.write_text('ID="debian"\n')
+    os.utime(release, (1000, 1000))
+    assert pkgmgrs.detect_backend(cache) == "apt"
+    assert len(probes) > count
+
+    available.clear()
+    with pytest.raises(pkgmgrs.Error):
+        pkgmgrs.detect_backend(str(tmp_path / "other.json"))
+
+
+@pytest.mark.parametrize(
+    "backend, expected",
+    [
+        ("pacman", ["pacman", "-Ss", "vim"]),
+        ("apt", ["apt", "search", "vim"]),
+        ("yum", ["yum", "search", "vim"]),
+        ("dnf", ["dnf", "search", "vim"]),
+    ],
+)
+def test_created_handler_runs_actions(backend, expected, monkeypatch):
+    handler = pkgmgrs.create_handler({}, backend=backend)
+    ran = []
+    monkeypatch.setattr(handler, "execute", lambda cmd: ran.append(cmd) or 0)
+    assert handler.action("find", ["vim"]) == 0
+    assert ran == [expected]
+
+
+class ScriptHandler(pkgmgrs.PackageHandler):
+    def find_cmds(self, args):
+        return [[sys.executable, "-c", args[0]]]
+
+
+def test_async_action_streams_lines():
+    handler = ScriptHandler()
+    lines = []
+    script = "print('one'); print('two'); raise SystemExit(3)"
+    result = asyncio.run(handler.async_action("find", [script], on_line=lines.append))
+    assert result == 3
+    assert lines == ["one", "two"]
+
+
+def test_async_action_timeout(capsys):
+    handler = ScriptHandler({"timeout": 0.2})
+    start = time.monotonic()
+    result = asyncio.run(handler.async_action("find", ["import time; time.sleep(5)"]))
+    assert result == pkgmgrs.TIMEOUT_RESULT
+    assert time.monotonic() - start < 2
+    assert "timed out" in capsys.readouterr().out
+
+
+def test_async_action_runs_in_process_actions(tmp_path):
+    (tmp_path / "status").write_text(DPKG_STATUS)
+    handler = pkgmgrs.AptHandler({"output": str(tmp_path / "out"), "quiet": True})
+    handler.status = str(tmp_path / "status")
+    assert asyncio.run(handler.async_action("list", [])) == 0
+    assert (tmp_path / "out").read_text().startswith("bash 5.2.15-2+b2 amd64")
+
+
+def test_subprocesses_are_timed():
+    mwtf.metrics().reset()
+    handler = pkgmgrs.PackageHandler()
+    handler.capture([sys.executable, "-c", "pass"])
+    handler.capture(["/nonexistent/wtftools-binary"])
+    counters, histograms = mwtf.metrics().snapshot()
+    label = os.path.basename(sys.executable)
+    assert histograms[("wtftools_subprocess_seconds", (("cmd", label),))][0] == 1
+    failures = ("wtftools_subprocess_failures_total", (("cmd", "wtftools-binary"),))
+    assert counters[failures] == 1
+
+
+class CountingHandler(pkgmgrs.PackageHandler):
+    """Backend whose queries append to a file so runs can be counted."""
+
+    def __init__(self, opts, runs):
+        super().__init__(opts)
+        self.runs = runs
+
+    def command(self, *words):
+        script = "import sys; open(sys.argv[1], 'a').write('x'); print(*sys.argv[2:])"
+        return [sys.executable, "-c", script, str(self.runs)] + list(words)
+
+    def find_cmds(self, args):
+        return [self.command("found", args[0])]
+
+    def install_cmds(self, args):
+        return [self.command("installed")]
+
+
+@pytest.fixture
+def counting(tmp_path):
+    pkgcache.forget()
+    runs = tmp_path / "runs"
+    runs.write_text("")
+    yield CountingHandler({"cache": True, "refresh": False}, runs)
+    pkgcache.forget()
+
+
+def test_result_cache_replays_answers(counting, capsys):
+    assert counting.action("search", ["vim"]) == 0
+    assert counting.action("search", ["vim"]) == 0
+    assert capsys.readouterr().out == "found vim\nfound vim\n"
+    assert counting.runs.read_text() == "x"
+    counting.action("search", ["emacs"])
+    assert counting.runs.read_text() == "xx"
+
+
+def test_result_cache_invalidation(counting, capsys):
+    counting.action("search", ["vim"])
+    counting.action("install", ["vim"])
+    counting.action("search", ["vim"])
+    assert counting.runs.read_text() == "xxx"
+    counting.options["refresh"] = True
+    counting.action("search", ["vim"])
+    assert counting.runs.read_text() == "xxxx"
+
+
+def test_result_cache_lru_and_ttl(tmp_path):
+    pathname = str(tmp_path / "results.json")
+    cache = pkgcache.ResultCache(size=2, ttl=60, pathname=pathname)
+    cache.put("a", 1, now=1000)
+    cache.put("b", 2, now=1000)
+    assert cache.get("a", now=1010) == 1
+    cache.put("c", 3, now=1010)
+    assert cache.get("b", now=1010) is None
+    assert cache.get("a", now=1061) is None
+    assert cache.get("c", now=1061) == 3
+
+    # entries written long ago have expired for a reader with a ttl
+    assert not pkgcache.ResultCache(ttl=60, pathname=pathname).entries
+    reloaded = pkgcache.ResultCache(size=2, ttl=None, pathname=pathname)
+    assert list(reloaded.entries) == ["a", "c"]
+    reloaded.put(pkgcache.ResultCache.key("dnf", "info"), 4)
+    reloaded.put(pkgcache.ResultCache.key("apt", "info"), 5)
+    reloaded.invalidate(("dnf",))
+    assert list(reloaded.entries) == ['["apt","info"]']
@@ -0,0 +1,76 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+WTFTOOLS = os.path.join(os.path.dirname(os.path.dirname(__file__)), "wtftools")
+
+# cumulative import time budget of each console entry point in
+# milliseconds, the eager imports these replaced cost pupflag about 130ms;
+# loaded runners can raise it with WTFTOOLS_STARTUP_BUDGET, 0 skips the check
+BUDGET = float(os.environ.get("WTFTOOLS_STARTUP_BUDGET", 60))
+ENTRY_POINTS = ["pupconfig", "pupfanout", "pupflag", "pupmonitor"]
+
+# modules that must only load when a feature needs them
+HEAVY = {
+    "yaml",
+    "configparser",
+    "smtplib",
+    "email",
+    "logging.handlers",
+    "asyncio",
+    "concurrent.futures",
+    "sqlite3",
+    "ctypes",
+    "mwtfmailer",
+    "mwtfsinks",
+}
+
+# heavy modules an entry point needs for every real run
+NEEDED = {"pupfanout": {"concurrent.futures"}}
+
+
+def python(code, *flags):
+    return subprocess.run(
+        [sys.executable, *flags, "-c", code],
+        cwd=WTFTOOLS,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def import_time(module):
+    """Return the cumulative import time of module in milliseconds."""
+    stderr = python("import %s" % module, "-X", "importtime").stderr
+    for line in stderr.splitlines():
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1000.0
+    raise AssertionError("no import time reported for %s" % module)
+
+
+@pytest.mark.skipif(not BUDGET, reason="WTFTOOLS_STARTUP_BUDGET is 0")
+@pytest.mark.parametrize("module", ENTRY_POINTS)
+def test_startup_budget(module):
+    import_time(module)  # warm the bytecode and page caches
+    best = min(import_time(module) for i in range(3))
+    assert best < BUDGET, "%s imports in %.1fms" % (module, best)
+
+
+@pytest.mark.parametrize("module", ENTRY_POINTS)
+def test_heavy_modules_are_not_imported(module):
+    code = "import sys, %s; print(' '.join(sys.modules))" % module
+    loaded = set(python(code).stdout.split())
+    assert loaded & HEAVY <= NEEDED.get(module, set())
+
+
+def test_flag_display_stays_light(tmp_path):
+    code = (
+        "import sys, mwtfpuppet\n"
+        "mwtfpuppet.PuppetFlags({'flagdir': %r, 'screen': False}).show_flags()\n"
+        "print(' '.join(sys.modules))\n" % str(tmp_path)
+    )
+    loaded = set(python(code).stdout.splitlines()[-1].split())
+    assert loaded & HEAVY == set()
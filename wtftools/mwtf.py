@@ -1,30 +1,127 @@
 # -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil -*-
 
+import atexit
+import json
 import os
+import socket
+import sys
+import threading
+import time
 
-import yaml
-from packaging import version
+# yaml is imported on first use; pupflag and friends start from cron many
+# times an hour and most runs never parse yaml
+__YAML_LOADERS__ = {}
 
-__HOSTNAME__ = None
-__DOMAINNAME__ = None
+
+def yaml_loaders():
+    """Return the (safe, full) yaml loaders, importing yaml on first call.
+
+    FullLoader arrived with PyYAML 5.1 and the C variants are only present
+    when PyYAML was built against libyaml.
+    """
+    if not __YAML_LOADERS__:
+        import yaml
+
+        if hasattr(yaml, "CSafeLoader"):
+            safe = yaml.CSafeLoader
+        else:
+            safe = yaml.SafeLoader
+        if hasattr(yaml, "CFullLoader"):
+            full = yaml.CFullLoader
+        elif hasattr(yaml, "FullLoader"):
+            full = yaml.FullLoader
+        else:
+            full = safe
+        __YAML_LOADERS__["YAML_SAFE_LOADER"] = safe
+        __YAML_LOADERS__["YAML_LOADER"] = full
+    return __YAML_LOADERS__["YAML_SAFE_LOADER"], __YAML_LOADERS__["YAML_LOADER"]
+
+
+def __getattr__(name):
+    # YAML_LOADER and YAML_SAFE_LOADER resolve lazily, see yaml_loaders()
+    if name in ("YAML_SAFE_LOADER", "YAML_LOADER"):
+        yaml_loaders()
+        return __YAML_LOADERS__[name]
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+class HostIdentity:
+    """Resolve host name, domain and fqdn in-process and cache the result.
+
+    The cache is keyed on the kernel node name so a hostname change is picked
+    up on the next lookup; invalidate() drops the cache explicitly.
+    """
+
+    def __init__(self, hostname_file="/etc/hostname"):
+        self.hostname_file = hostname_file
+        self.invalidate()
+
+    def invalidate(self):
+        self._nodename = None
+        self._hostname = None
+        self._domainname = None
+
+    def _check(self):
+        nodename = os.uname().nodename
+        if nodename != self._nodename:
+            self.invalidate()
+            self._nodename = nodename
+
+    def hostname(self):
+        self._check()
+        if self._hostname is None:
+            self._hostname = self._nodename or self.__read_hostname_file()
+            if not self._hostname:
+                self._hostname = socket.gethostname()
+        return self._hostname
+
+    def domainname(self):
+        host = self.hostname()
+        if self._domainname is None:
+            if "." in host:
+                name = host
+            else:
+                try:
+                    name = socket.getfqdn(host)
+                except OSError:
+                    name = host
+            self._domainname = name.partition(".")[2]
+        return self._domainname
+
+    def shortname(self):
+        return self.hostname().partition(".")[0]
+
+    def fqdn(self):
+        domain = self.domainname()
+        if domain:
+            return "%s.%s" % (self.shortname(), domain)
+        return self.shortname()
+
+    def __read_hostname_file(self):
+        try:
+            with open(self.hostname_file) as f:
+                return f.readline().strip()
+        except OSError:
+            return ""
+
+
+__IDENTITY__ = HostIdentity()
 
 
 def hostname():
-    global __HOSTNAME__
-    if __HOSTNAME__ is None:
-        __HOSTNAME__ = os.popen("hostname").read().rstrip()
-    return __HOSTNAME__
+    return __IDENTITY__.hostname()
 
 
 def domainname():
-    global __DOMAINNAME__
-    if __DOMAINNAME__ is None:
-        __DOMAINNAME__ = os.popen("hostname -d").read().rstrip()
-    return __DOMAINNAME__
+    return __IDENTITY__.domainname()
 
 
 def fqdn():
-    return "%s.%s" % (hostname(), domainname())
+    return __IDENTITY__.fqdn()
+
+
+def invalidate_host_identity():
+    __IDENTITY__.invalidate()
 
 
 def uptime(elevate=True):
@@ -39,24 +136,26 @@ def uptime(elevate=True):
 
 
 def secsepochsince():
-    return int(os.popen("date '+%s'").read().rstrip())
+    return int(time.time())
 
 
-def load_yaml(pathname):
-    with open(pathname) as file:
-        if version.parse(yaml.__version__) < version.parse("5.1"):
-            result = yaml.safe_load(file)
-        else:
-            result = yaml.full_load(file)
+def load_yaml(pathname, loader=None):
+    import yaml
+
+    if loader is None:
+        loader = yaml_loaders()[1]
+    with __METRICS__.span("wtftools_parse_seconds", kind="yaml"):
+        with open(pathname, "rb") as file:
+            result = yaml.load(file, Loader=loader)
     return result
 
 
 def file_age(pathname):
-    if os.path.exists(pathname):
-        result = secsepochsince() - int(os.path.getmtime(pathname))
-    else:
-        result = 0
-    return result
+    try:
+        mtime = os.stat(pathname).st_mtime
+    except FileNotFoundError:
+        return 0
+    return int(time.time()) - int(mtime)
 
 
 def ensure_directory(dir, perm=0o755):
@@ -72,14 +171,331 @@ def requires_super_user(prefix="Specified action"):
         raise PermissionError("%s requires super user priviledges." % prefix)
 
 
+# upper bounds in seconds of the timing histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+
+
+class Span:
+    """Context manager observing its elapsed time into a Metrics histogram."""
+
+    __slots__ = ("metrics", "key", "start")
+
+    def __init__(self, metrics, key):
+        self.metrics = metrics
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe_key(self.key, time.perf_counter() - self.start)
+        return False
+
+
+class Metrics:
+    """Process wide counters and timing histograms.
+
+    A metric is a name plus labels; updates are a dict lookup and a few
+    additions under a lock, cheap enough to leave on in production runs.
+    Export as a Prometheus textfile collector file or as json.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        self.observe_key((name, tuple(sorted(labels.items()))), seconds)
+
+    def observe_key(self, key, seconds):
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = [0, 0.0, [0] * len(self.buckets)]
+                self.histograms[key] = histogram
+            histogram[0] += 1
+            histogram[1] += seconds
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[2][i] += 1
+                    break
+
+    def span(self, name, **labels):
+        """Return a context manager timing its block into histogram name."""
+        return Span(self, (name, tuple(sorted(labels.items()))))
+
+    def snapshot(self):
+        """Return (counters, histograms) copies with cumulative buckets."""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {}
+            for key, (count, total, buckets) in self.histograms.items():
+                cumulative = []
+                running = 0
+                for value in buckets:
+                    running += value
+                    cumulative.append(running)
+                histograms[key] = (count, total, cumulative)
+        return counters, histograms
+
+    def prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        counters, histograms = self.snapshot()
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE %s counter" % name)
+            lines.append("%s%s %s" % (name, prometheus_labels(labels), value))
+        for (name, labels), (count, total, cumulative) in sorted(histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE %s histogram" % name)
+            for bound, value in zip(self.buckets, cumulative):
+                le = prometheus_labels(labels + (("le", repr(bound)),))
+                lines.append("%s_bucket%s %d" % (name, le, value))
+            le = prometheus_labels(labels + (("le", "+Inf"),))
+            lines.append("%s_bucket%s %d" % (name, le, count))
+            lines.append("%s_sum%s %r" % (name, prometheus_labels(labels), total))
+            lines.append("%s_count%s %d" % (name, prometheus_labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+    def as_dict(self):
+        counters, histograms = self.snapshot()
+        return {
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(counters.items())
+            ],
+            "histograms": [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": count,
+                    "sum": total,
+                    "buckets": dict(zip((repr(b) for b in self.buckets), cumulative)),
+                }
+                for (name, labels), (count, total, cumulative) in sorted(
+                    histograms.items()
+                )
+            ],
+        }
+
+    def write(self, pathname, format=None):
+        """Atomically write the metrics, format is taken from a .json suffix."""
+        if format is None:
+            format = "json" if pathname.endswith(".json") else "prometheus"
+        if format == "json":
+            text = json.dumps(self.as_dict(), indent=2, sort_keys=True) + "\n"
+        else:
+            text = self.prometheus()
+        tmp = "%s.%d" % (pathname, os.getpid())
+        with open(tmp, "w") as f:
+            f.write(text)
+        os.replace(tmp, pathname)
+
+
+def prometheus_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n")
+        pairs.append('%s="%s"' % (key, value.replace('"', '\\"')))
+    return "{%s}" % ",".join(pairs)
+
+
+__METRICS__ = Metrics()
+__EXPORTS__ = set()
+
+
+def metrics():
+    """Return the process wide Metrics registry."""
+    return __METRICS__
+
+
+def export_metrics_at_exit(pathname):
+    """Write the process wide metrics to pathname when the process exits."""
+    if pathname not in __EXPORTS__:
+        __EXPORTS__.add(pathname)
+        atexit.register(__METRICS__.write, pathname)
+
+
+def add_profile_options(parser):
+    """Add --profile, --profile-dir and --profile-top to an OptionParser."""
+    parser.add_option(
+        "--profile",
+        action="store_const",
+        const="auto",
+        dest="profile",
+        default=os.environ.get("WTFTOOLS_PROFILE"),
+        help="profile the run (also WTFTOOLS_PROFILE=auto|cprofile|sampling)",
+    )
+    parser.add_option(
+        "--profile-dir",
+        action="store",
+        dest="profile_dir",
+        default=os.environ.get("WTFTOOLS_PROFILE_DIR"),
+        help="directory for profile output (also WTFTOOLS_PROFILE_DIR)",
+    )
+    parser.add_option(
+        "--profile-top",
+        action="store",
+        type="int",
+        dest="profile_top",
+        default=0,
+        help="print the N most expensive functions after the run",
+    )
+
+
+def profiled(options, func, *args, **kwargs):
+    """Call func, under a profiler when the profile option asks for one.
+
+    profile is "cprofile", "sampling" (pyinstrument) or "auto", which
+    samples when pyinstrument is installed and uses cProfile otherwise.
+    cProfile output is saved as pstats, sampled output as collapsed stacks
+    for flamegraph tools, named after the caller and host in profile_dir.
+    """
+    kind = options.get("profile") or os.environ.get("WTFTOOLS_PROFILE")
+    if not kind or str(kind).lower() in ("0", "no", "off", "false"):
+        return func(*args, **kwargs)
+    kind = str(kind).lower()
+    sampler = None
+    if kind != "cprofile":
+        try:
+            import pyinstrument
+        except ImportError:
+            if kind == "sampling":
+                print(
+                    "NOTICE: pyinstrument is not installed, using cProfile",
+                    file=sys.stderr,
+                )
+        else:
+            sampler = pyinstrument.Profiler(interval=0.001)
+    if sampler is None:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    else:
+        sampler.start()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        top = options.get("profile_top") or 0
+        if sampler is None:
+            profiler.disable()
+            pathname = profile_pathname(options, "pstats")
+            profiler.dump_stats(pathname)
+            if top:
+                import pstats
+
+                stats = pstats.Stats(profiler, stream=sys.stderr)
+                stats.sort_stats("cumulative").print_stats(top)
+        else:
+            stacks = collapse_frames(sampler.stop().root_frame())
+            pathname = profile_pathname(options, "collapsed")
+            with open(pathname, "w") as f:
+                for stack, seconds in sorted(stacks.items()):
+                    if seconds >= 1e-6:
+                        f.write("%s %d\n" % (stack, round(seconds * 1e6)))
+            if top:
+                print_top_frames(stacks, top)
+        print("profile written to %s" % pathname, file=sys.stderr)
+
+
+def profile_pathname(options, suffix):
+    directory = options.get("profile_dir") or os.environ.get("WTFTOOLS_PROFILE_DIR")
+    if not directory:
+        import tempfile
+
+        directory = os.path.join(tempfile.gettempdir(), "wtftools-profiles")
+    ensure_directory(directory, 0o700)
+    caller = os.path.basename(str(options.get("caller") or "wtftools"))
+    return os.path.join(
+        directory,
+        "%s-%s-%s-%d.%s"
+        % (
+            caller,
+            hostname(),
+            time.strftime("%Y%m%dT%H%M%S"),
+            os.getpid(),
+            suffix,
+        ),
+    )
+
+
+def collapse_frames(frame, stack=(), stacks=None):
+    """Return {"outer;...;inner": self seconds} for a pyinstrument frame tree."""
+    if stacks is None:
+        stacks = {}
+    if frame is None:
+        return stacks
+    name = "%s (%s:%s)" % (frame.function, frame.file_path_short, frame.line_no)
+    stack = stack + (name.replace(";", ":"),)
+    self_time = frame.time - sum(child.time for child in frame.children)
+    if self_time > 0:
+        key = ";".join(stack)
+        stacks[key] = stacks.get(key, 0) + self_time
+    for child in frame.children:
+        collapse_frames(child, stack, stacks)
+    return stacks
+
+
+def print_top_frames(stacks, top, stream=None):
+    """Print the top functions by sampled self time."""
+    if stream is None:
+        stream = sys.stderr
+    totals = {}
+    for stack, seconds in stacks.items():
+        leaf = stack.rpartition(";")[2]
+        totals[leaf] = totals.get(leaf, 0) + seconds
+    ranked = sorted(totals.items(), key=lambda item: item[1], reverse=True)
+    print("%10s  %s" % ("self secs", "function"), file=stream)
+    for leaf, seconds in ranked[:top]:
+        print("%10.4f  %s" % (seconds, leaf), file=stream)
+
+
 class Options:
     def __init__(self, opts={}):
-        self.options = {"debug": 0, "verbose": 0, "test": False}
+        self.options = {
+            "debug": 0,
+            "verbose": 0,
+            "test": False,
+            "metrics_file": os.environ.get("WTFTOOLS_METRICS_FILE"),
+        }
         self.errors = 0
         self.options.update(opts)
+        self.metrics = __METRICS__
+        if self.options["metrics_file"]:
+            export_metrics_at_exit(self.options["metrics_file"])
         if self.options["test"]:
             print("created instance of class %s" % self.__class__.__name__)
 
+    def profiled(self, func, *args, **kwargs):
+        """Call func under the profiler selected by the profile options."""
+        return profiled(self.options, func, *args, **kwargs)
+
+    def span(self, name, **labels):
+        """Time a block into histogram name of the process wide registry."""
+        return self.metrics.span(name, **labels)
+
+    def count(self, name, value=1, **labels):
+        self.metrics.count(name, value, **labels)
+
     def isdebug(self):
         return self.options["debug"] > 0
 
@@ -0,0 +1,176 @@
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import json
+import os
+import time
+
+import mwtfscribe
+
+RAISED = "raised"
+CLEARED = "cleared"
+
+__STORES__ = {}
+__BUCKETS__ = {}
+
+
+class TokenBucket:
+    """Allow rate transitions per second on average and burst at once."""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def allow(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class AlertStore:
+    """Alert state keyed by alert key, optionally persisted as json.
+
+    Persisting lets short lived commands deduplicate against earlier runs.
+    """
+
+    def __init__(self, pathname=None):
+        self.pathname = pathname
+        self.alerts = {}
+        if pathname is not None:
+            try:
+                with open(pathname) as f:
+                    self.alerts = json.load(f)
+            except (OSError, ValueError):
+                self.alerts = {}
+
+    def state(self, key):
+        alert = self.alerts.get(key)
+        return CLEARED if alert is None else alert["state"]
+
+    def update(self, key, state, subject=None):
+        self.alerts[key] = {"state": state, "since": int(time.time())}
+        if subject is not None:
+            self.alerts[key]["subject"] = subject
+        self.save()
+
+    def raised(self):
+        return [key for key in self.alerts if self.alerts[key]["state"] == RAISED]
+
+    def save(self):
+        if self.pathname is None:
+            return
+        tmp = "%s.%d" % (self.pathname, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(self.alerts, f)
+        os.replace(tmp, self.pathname)
+
+
+def alert_store(pathname=None):
+    """Return the process wide AlertStore for pathname, None is in memory."""
+    if pathname not in __STORES__:
+        __STORES__[pathname] = AlertStore(pathname)
+    return __STORES__[pathname]
+
+
+class LogSink:
+    """Deliver alert transitions to the alerter's log."""
+
+    def raise_alert(self, alerter, alert):
+        alerter.log.error("ALERT %s: %s", alert["key"], alert["subject"])
+
+    def clear_alert(self, alerter, alert):
+        alerter.log.warning("CLEAR %s", alert["key"])
+
+
+class MailSink(LogSink):
+    """Deliver alert transitions by mail, and to the log."""
+
+    def __init__(self, opts={}):
+        import mwtfmailer
+
+        self.mailer = mwtfmailer.Mailer(opts)
+
+    def raise_alert(self, alerter, alert):
+        super().raise_alert(alerter, alert)
+        self.mailer.send(
+            {"to": alerter.options["alert_to"], "subject": alert["subject"]},
+            alert["message"],
+        )
+
+    def clear_alert(self, alerter, alert):
+        super().clear_alert(alerter, alert)
+        self.mailer.send(
+            {"to": alerter.options["alert_to"], "subject": "CLEARED %s" % alert["key"]},
+            "%s has cleared." % alert["key"],
+        )
+
+
+class Alerter(mwtfscribe.Scribe):
+    """Scribe that raises and clears keyed alerts.
+
+    Only state transitions reach the sink, repeated raises or clears of the
+    same key are dropped, and transitions of a key are rate limited with a
+    token bucket (alert_rate per second, alert_burst at once). A rate
+    limited transition is not recorded so a later call retries it.
+    """
+
+    def __init__(self, opts={}):
+        aopts = {
+            "alert_sink": "log",
+            "alert_state": None,
+            "alert_rate": 1.0 / 60,
+            "alert_burst": 2,
+            "alert_to": "root",
+        }
+        aopts.update(opts)
+        super().__init__(aopts)
+        self.alerts = alert_store(self.options["alert_state"])
+        sink = self.options["alert_sink"]
+        if sink == "log":
+            self.sink = LogSink()
+        elif sink == "mail":
+            self.sink = MailSink(
+                {"debug": self.options["debug"], "verbose": self.options["verbose"]}
+            )
+        else:
+            self.sink = sink
+
+    def raise_alert(self, args):
+        alert = {
+            "key": args["key"],
+            "subject": args.get("subject", args["key"]),
+            "message": args.get("message", args.get("subject", args["key"])),
+        }
+        if not self.__transition(alert["key"], RAISED):
+            return False
+        self.sink.raise_alert(self, alert)
+        self.alerts.update(alert["key"], RAISED, alert["subject"])
+        return True
+
+    def clear(self, args):
+        alert = {"key": args["key"]}
+        if not self.__transition(alert["key"], CLEARED):
+            return False
+        self.sink.clear_alert(self, alert)
+        self.alerts.update(alert["key"], CLEARED)
+        return True
+
+    def __transition(self, key, state):
+        if self.alerts.state(key) == state:
+            return False
+        bucket = __BUCKETS__.get(key)
+        if bucket is None:
+            bucket = TokenBucket(
+                self.options["alert_rate"], self.options["alert_burst"]
+            )
+            __BUCKETS__[key] = bucket
+        if not bucket.allow():
+            self.debug("alert %s rate limited" % key)
+            return False
+        return True
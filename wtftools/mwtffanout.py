@@ -0,0 +1,257 @@
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import collections
+import concurrent.futures
+import shlex
+import subprocess
+import time
+
+import mwtfscribe
+
+TIMEOUT_RESULT = 124
+NOT_FOUND_RESULT = 127
+
+HostResult = collections.namedtuple(
+    "HostResult", ["host", "returncode", "value", "error", "elapsed"]
+)
+
+
+class LocalTransport:
+    """Run the query command on this host, the host name is only a label."""
+
+    def command(self, host, cmd):
+        return list(cmd)
+
+    def run(self, host, cmd, timeout=None):
+        """Return (returncode, stdout, stderr) of cmd for host."""
+        try:
+            proc = subprocess.run(
+                self.command(host, cmd),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                timeout=timeout,
+            )
+        except subprocess.TimeoutExpired:
+            return TIMEOUT_RESULT, "", "timed out after %s seconds" % timeout
+        except FileNotFoundError as ex:
+            return NOT_FOUND_RESULT, "", str(ex)
+        except OSError as ex:
+            return 1, "", str(ex)
+        return (
+            proc.returncode,
+            proc.stdout.decode(errors="replace"),
+            proc.stderr.decode(errors="replace"),
+        )
+
+
+class SshTransport(LocalTransport):
+    """Run the query command on each host through ssh in batch mode."""
+
+    def __init__(self, ssh="ssh", options=(), connect_timeout=10):
+        self.ssh = ssh
+        self.options = list(options)
+        self.connect_timeout = connect_timeout
+
+    def command(self, host, cmd):
+        argv = [self.ssh, "-o", "BatchMode=yes"]
+        argv += ["-o", "ConnectTimeout=%d" % self.connect_timeout]
+        for option in self.options:
+            argv += ["-o", option]
+        return argv + [host, "--", " ".join(shlex.quote(arg) for arg in cmd)]
+
+
+class FakeTransport:
+    """Answer queries from a mapping of host to (returncode, stdout, stderr).
+
+    A value may also be a callable taking the command, hosts missing from
+    the mapping fail as if they could not be resolved.
+    """
+
+    def __init__(self, answers, delay=0):
+        self.answers = answers
+        self.delay = delay
+        self.calls = []
+
+    def run(self, host, cmd, timeout=None):
+        self.calls.append((host, list(cmd)))
+        if self.delay:
+            time.sleep(self.delay)
+        answer = self.answers.get(host)
+        if answer is None:
+            return 255, "", "ssh: Could not resolve hostname %s" % host
+        if callable(answer):
+            return answer(cmd)
+        return answer
+
+
+class FlagQuery:
+    """Collect the pupflag flag states of a host."""
+
+    cmd = ["pupflag"]
+
+    def parse(self, stdout):
+        flags = collections.OrderedDict()
+        for line in stdout.splitlines():
+            name, sep, value = line.partition("=")
+            if sep and name.startswith("wtfo_puppet_"):
+                flags[name[12:]] = value.strip() == "True"
+        if not flags:
+            raise ValueError("no flags in output")
+        return flags
+
+    def tally(self, value):
+        return ["%s=%s" % (flag, state) for flag, state in value.items()]
+
+    def render(self, value):
+        return " ".join(self.tally(value))
+
+
+class SettingQuery:
+    """Collect one puppet.conf setting of a host through pupconfig."""
+
+    def __init__(self, key, section="agent"):
+        self.key = key
+        self.section = section
+        self.cmd = ["pupconfig", "-s", section, key]
+
+    def parse(self, stdout):
+        prefix = "[%s] %s = " % (self.section, self.key)
+        for line in stdout.splitlines():
+            if line.startswith(prefix):
+                return line[len(prefix) :]
+        raise ValueError("no %s setting in output" % self.key)
+
+    def tally(self, value):
+        return ["%s = %s" % (self.key, value)]
+
+    def render(self, value):
+        return self.tally(value)[0]
+
+
+class FanOutReport:
+    """Aggregated results of one query over many hosts."""
+
+    def __init__(self, query):
+        self.query = query
+        self.results = []
+        self.started = time.monotonic()
+        self.finished = None
+
+    def add(self, result):
+        self.results.append(result)
+
+    def ok(self):
+        return [r for r in self.results if r.error is None]
+
+    def failed(self):
+        return [r for r in self.results if r.error is not None]
+
+    def tally(self):
+        counts = collections.Counter()
+        for result in self.ok():
+            counts.update(self.query.tally(result.value))
+        return counts
+
+    def wall_time(self):
+        end = time.monotonic() if self.finished is None else self.finished
+        return end - self.started
+
+    def lines(self):
+        ok = self.ok()
+        failed = self.failed()
+        lines = [
+            "hosts: %d ok: %d failed: %d wall: %.1fs"
+            % (len(self.results), len(ok), len(failed), self.wall_time())
+        ]
+        if self.results:
+            slowest = max(self.results, key=lambda r: r.elapsed)
+            lines.append("slowest: %s %.1fs" % (slowest.host, slowest.elapsed))
+        for key, count in sorted(self.tally().items()):
+            lines.append("%s: %d" % (key, count))
+        for result in sorted(failed, key=lambda r: r.host):
+            lines.append(
+                "failed: %s (%d) %s" % (result.host, result.returncode, result.error)
+            )
+        return lines
+
+
+class FanOut(mwtfscribe.Scribe):
+    """Run a flag or setting query against many hosts concurrently.
+
+    At most jobs hosts are queried at once, each result is reported as soon
+    as its host answers, so the wall time is set by the slowest hosts
+    rather than the sum over all hosts.
+    """
+
+    def __init__(self, opts={}):
+        fopts = {"jobs": 32, "timeout": 60, "transport": None}
+        fopts.update(opts)
+        super().__init__(fopts)
+        self.transport = self.options["transport"] or SshTransport()
+
+    def query(self, host, query):
+        start = time.monotonic()
+        returncode, stdout, stderr = self.transport.run(
+            host, query.cmd, self.options["timeout"]
+        )
+        value = None
+        error = None
+        if returncode != 0:
+            error = stderr.strip().splitlines()[-1] if stderr.strip() else "failed"
+        else:
+            try:
+                value = query.parse(stdout)
+            except ValueError as ex:
+                error = str(ex)
+        elapsed = time.monotonic() - start
+        self.metrics.observe("wtftools_fanout_host_seconds", elapsed)
+        if error is not None:
+            self.count("wtftools_fanout_failures_total")
+        return HostResult(host, returncode, value, error, elapsed)
+
+    def iter_results(self, hosts, query):
+        """Yield a HostResult for every host in completion order."""
+        hosts = list(collections.OrderedDict.fromkeys(hosts))
+        if not hosts:
+            return
+        jobs = max(1, min(int(self.options["jobs"]), len(hosts)))
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            futures = [pool.submit(self.query, host, query) for host in hosts]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    yield future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def run(self, hosts, query, on_result=None):
+        """Query every host, pass each result to on_result, return the report."""
+        report = FanOutReport(query)
+        for result in self.iter_results(hosts, query):
+            report.add(result)
+            if result.error is not None:
+                self.debug("%s: %s" % (result.host, result.error))
+                self.errors += 1
+            if on_result is not None:
+                on_result(result)
+        report.finished = time.monotonic()
+        return report
+
+    def cli_run(self, hosts):
+        if self.options.get("setting") is not None:
+            query = SettingQuery(self.options["setting"], self.options["section"])
+        else:
+            query = FlagQuery()
+
+        def show(result):
+            if result.error is None:
+                print("%s: %s" % (result.host, query.render(result.value)))
+            else:
+                print("%s: FAILED %s" % (result.host, result.error))
+
+        report = self.run(hosts, query, show)
+        print("")
+        for line in report.lines():
+            print(line)
+        return self.errors
@@ -1,39 +1,438 @@
 # -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil -*-
+import atexit
+import collections
+import fcntl
+import heapq
+import json
+import os
+import smtplib
 import sys
+import threading
+import time
+import uuid
 from email.mime.text import MIMEText
 from subprocess import PIPE, Popen
 
 import mwtf
 
+__POOLS__ = {}
+__POOLS_LOCK__ = threading.Lock()
+__SPOOLS__ = {}
+
+
+class SMTPPool:
+    """Keep one reusable SMTP session per server, login and TLS setting.
+
+    A session idle for longer than idle seconds is probed with NOOP before
+    reuse and replaced when the server dropped it. The pool is shared with
+    the spool thread, so the session is only used under the lock.
+    """
+
+    def __init__(
+        self, host, port, user=None, password=None, starttls=False, timeout=30, idle=30
+    ):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.idle = idle
+        self.smtp = None
+        self.used = 0
+        self.connects = 0
+        self.lock = threading.Lock()
+
+    def connection(self):
+        if self.smtp is not None and time.monotonic() - self.used > self.idle:
+            try:
+                if self.smtp.noop()[0] != 250:
+                    self.__quit()
+            except OSError:
+                self.__drop()
+        if self.smtp is None:
+            self.smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            self.connects += 1
+            if self.starttls:
+                self.smtp.starttls()
+            if self.user is not None:
+                self.smtp.login(self.user, self.password)
+        self.used = time.monotonic()
+        return self.smtp
+
+    def send(self, msg):
+        with self.lock:
+            try:
+                self.connection().send_message(msg)
+            except OSError as ex:
+                # a refusal is final, a lost session is retried once on a
+                # fresh one; a reset socket raises a plain OSError
+                if isinstance(ex, smtplib.SMTPException) and not isinstance(
+                    ex, smtplib.SMTPServerDisconnected
+                ):
+                    raise
+                self.__drop()
+                self.connection().send_message(msg)
+
+    def close(self):
+        with self.lock:
+            self.__quit()
+
+    def __quit(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except OSError:
+                self.__drop()
+            self.smtp = None
+
+    def __drop(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.close()
+            except OSError:
+                pass
+            self.smtp = None
+
+
+def smtp_pool(
+    host, port, user=None, password=None, starttls=False, timeout=30, idle=30
+):
+    """Return the process wide SMTPPool for the server, login and settings."""
+    key = (host, port, user, password, starttls, timeout, idle)
+    with __POOLS_LOCK__:
+        if key not in __POOLS__:
+            __POOLS__[key] = SMTPPool(
+                host, port, user, password, starttls, timeout, idle
+            )
+        return __POOLS__[key]
+
+
+def close_pools():
+    with __POOLS_LOCK__:
+        pools = list(__POOLS__.values())
+    for pool in pools:
+        pool.close()
+
+
+class Delivery:
+    """Handle for a message handed to a SpoolQueue."""
+
+    def __init__(self, name, mailer=None):
+        self.name = name
+        self.mailer = mailer
+        self.result = None
+        self.attempts = 0
+        self.event = threading.Event()
+
+    def done(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the final result, None when still pending after timeout."""
+        self.event.wait(timeout)
+        return self.result
+
+    def finish(self, result):
+        self.result = result
+        self.event.set()
+
+
+class SpoolQueue:
+    """Deliver mail from a spool directory on a background thread.
+
+    Each message is written to the spool before send() returns, so a crash
+    loses nothing, messages left in the spool are picked up again when the
+    queue for that directory starts. A message is delivered by the mailer
+    that submitted it, left over messages by the queue's mailer. Failed
+    deliveries are retried with exponential backoff and moved to the failed
+    subdirectory after retries attempts. Processes sharing a spool take an
+    flock on it around each delivery, so a message goes out only once.
+    """
+
+    def __init__(
+        self, mailer, spool, retries=5, backoff=1.0, max_backoff=300, drain=30
+    ):
+        self.mailer = mailer
+        self.spool = spool
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.drain_timeout = drain
+        self.deliveries = {}
+        self.due = []
+        self.cond = threading.Condition()
+        self.busy = False
+        mwtf.ensure_directory(spool, 0o700)
+        self.lock = os.open(
+            os.path.join(spool, ".lock"), os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600
+        )
+        for entry in sorted(os.listdir(spool)):
+            if entry.endswith(".json"):
+                self.__schedule(entry, 0)
+        self.thread = threading.Thread(target=self.__run, name="mailspool", daemon=True)
+        self.thread.start()
+
+    def submit(self, args, body, mailer=None):
+        name = "%d-%s.json" % (time.time_ns(), uuid.uuid4().hex)
+        self.__write(name, {"args": args, "body": body, "attempts": 0})
+        with self.cond:
+            delivery = self.__schedule(name, 0, mailer)
+            self.cond.notify()
+        return delivery
+
+    def pending(self):
+        with self.cond:
+            return len(self.due) + (1 if self.busy else 0)
+
+    def drain(self, timeout=None):
+        """Wait until no message is waiting for delivery or a retry."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while self.due or self.busy:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                self.cond.wait(remaining)
+        return True
+
+    def __schedule(self, name, delay, mailer=None):
+        delivery = self.deliveries.get(name)
+        if delivery is None:
+            delivery = Delivery(name, mailer)
+            self.deliveries[name] = delivery
+        heapq.heappush(self.due, (time.monotonic() + delay, name))
+        return delivery
+
+    def __write(self, name, data):
+        pathname = os.path.join(self.spool, name)
+        tmp = os.path.join(self.spool, ".%s.tmp" % name)
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, pathname)
+
+    def __run(self):
+        while True:
+            with self.cond:
+                while not self.due or self.due[0][0] > time.monotonic():
+                    timeout = None
+                    if self.due:
+                        timeout = self.due[0][0] - time.monotonic()
+                    self.cond.wait(timeout)
+                due, name = heapq.heappop(self.due)
+                self.busy = True
+            try:
+                fcntl.flock(self.lock, fcntl.LOCK_EX)
+                try:
+                    self.__deliver(name)
+                finally:
+                    fcntl.flock(self.lock, fcntl.LOCK_UN)
+            except Exception as ex:
+                # keep serving the spool, the message stays for a later run
+                print("NOTICE: spooled message %s failed: %s" % (name, ex))
+                self.__finish(name, 1)
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
+
+    def __deliver(self, name):
+        pathname = os.path.join(self.spool, name)
+        delivery = self.deliveries[name]
+        try:
+            with open(pathname) as f:
+                data = json.load(f)
+            args, body = data["args"], data["body"]
+        except FileNotFoundError:
+            # another process serving the spool has handled it
+            failed = os.path.exists(os.path.join(self.spool, "failed", name))
+            self.__finish(name, 1 if failed else 0)
+            return
+        except (OSError, ValueError, KeyError, TypeError) as ex:
+            print("NOTICE: spooled message %s unreadable: %s" % (name, ex))
+            self.__fail(name, 1)
+            return
+        mailer = self.mailer if delivery.mailer is None else delivery.mailer
+        try:
+            result = mailer.deliver(args, body)
+        except Exception as ex:
+            print("NOTICE: spooled message %s not delivered: %s" % (name, ex))
+            result = 1
+        if result == 0:
+            os.unlink(pathname)
+            self.__finish(name, 0)
+            return
+        data["attempts"] = data.get("attempts", 0) + 1
+        delivery.attempts = data["attempts"]
+        if data["attempts"] <= self.retries:
+            self.__write(name, data)
+            delay = min(self.backoff * 2 ** (data["attempts"] - 1), self.max_backoff)
+            with self.cond:
+                self.__schedule(name, delay)
+            return
+        self.__fail(name, result)
+
+    def __fail(self, name, result):
+        failed = os.path.join(self.spool, "failed")
+        mwtf.ensure_directory(failed, 0o700)
+        os.replace(os.path.join(self.spool, name), os.path.join(failed, name))
+        self.__finish(name, result)
+
+    def __finish(self, name, result):
+        with self.cond:
+            delivery = self.deliveries.pop(name, None)
+        if delivery is not None:
+            delivery.finish(result)
+
+
+def spool_queue(mailer, spool, retries=5, backoff=1.0, drain=30):
+    """Return the process wide SpoolQueue for a spool directory.
+
+    The first queue registers drain_spools() to run at exit.
+    """
+    if not __SPOOLS__:
+        atexit.register(drain_spools)
+    if spool not in __SPOOLS__:
+        __SPOOLS__[spool] = SpoolQueue(mailer, spool, retries, backoff, drain=drain)
+    return __SPOOLS__[spool]
+
+
+def drain_spools():
+    """Give every spool queue up to its drain timeout to deliver its mail.
+
+    Whatever is still queued stays in the spool for the next process.
+    """
+    for queue in list(__SPOOLS__.values()):
+        queue.drain(queue.drain_timeout)
+
 
 class Mailer(mwtf.Options):
     def __init__(self, opts={}):
-        mopts = {"transport": "sendmail"}
+        mopts = {
+            "transport": "sendmail",
+            "smtp_host": "localhost",
+            "smtp_port": 25,
+            "smtp_user": None,
+            "smtp_password": None,
+            "smtp_starttls": False,
+            "smtp_timeout": 30,
+            "spool": None,
+            "spool_retries": 5,
+            "spool_backoff": 1.0,
+            "spool_drain": 30,
+        }
         mopts.update(opts)
         super().__init__(mopts)
+        self.pending = []
 
     def send(self, args, body):
-        if self.options["transport"] == "sendmail":
-            result = self.__send_sendmail(args, body)
-        elif self.options["transport"] == "smtp":
-            result = self.__send_smtp(args, body)
-        else:
-            print("NOTICE: mailer %s is not supported!" % self.options["transport"])
-            result = 1
+        """Deliver a message and return the transport's exit status.
+
+        With the spool option the message is queued for background delivery
+        instead and a Delivery handle is returned immediately.
+        """
+        if self.options["spool"] is not None:
+            return self.spool_queue().submit(args, body, self)
+        return self.deliver(args, body)
+
+    def spool_queue(self):
+        return spool_queue(
+            self,
+            self.options["spool"],
+            self.options["spool_retries"],
+            self.options["spool_backoff"],
+            self.options["spool_drain"],
+        )
+
+    def deliver(self, args, body):
+        transport = self.options["transport"]
+        with self.span("wtftools_mail_seconds", transport=transport):
+            if transport == "sendmail":
+                result = self.__send_sendmail(args, body)
+            elif transport == "smtp":
+                result = self.__send_smtp(args, body)
+            else:
+                print("NOTICE: mailer %s is not supported!" % transport)
+                result = 1
+        if result:
+            self.count("wtftools_mail_failures_total", transport=transport)
         return result
 
-    def __send_smtp(self, args, body):
-        print("NOTICE: mailer __send_smtp not implemented yet!")
-        print(args, body)
-        return 1
+    def queue(self, args, body):
+        """Hold a message until flush() delivers the queued batch."""
+        self.pending.append((args, body))
 
-    def __send_sendmail(self, args, body):
+    def flush(self, digest=False):
+        """Deliver queued messages, return the number that failed.
+
+        With digest, messages to the same recipients are combined into one.
+        """
+        pending, self.pending = self.pending, []
+        if digest:
+            pending = self.digest(pending)
+        failed = 0
+        for args, body in pending:
+            result = self.send(args, body)
+            if not isinstance(result, Delivery) and result:
+                failed += 1
+        return failed
+
+    def digest(self, messages):
+        groups = collections.OrderedDict()
+        for args, body in messages:
+            key = (args.get("from", "root"), args.get("to", "root"), args.get("cc"))
+            groups.setdefault(key, []).append((args, body))
+        result = []
+        for (sender, to, cc), group in groups.items():
+            if len(group) == 1:
+                result.append(group[0])
+                continue
+            args = {"from": sender, "to": to}
+            if cc is not None:
+                args["cc"] = cc
+            args["subject"] = "Digest of %d messages" % len(group)
+            parts = []
+            for margs, body in group:
+                subject = margs.get("subject", "No subject provided")
+                parts.append("%s\n%s\n\n%s" % (subject, "-" * len(subject), body))
+            result.append((args, "\n\n".join(parts)))
+        return result
+
+    def message(self, args, body):
         msg = MIMEText(body)
         msg["From"] = args.get("from", "root")
         msg["To"] = args.get("to", "root")
         if "cc" in args:
             msg["Cc"] = args["cc"]
         msg["Subject"] = args.get("subject", "No subject provided")
+        return msg
+
+    def __send_smtp(self, args, body):
+        pool = smtp_pool(
+            self.options["smtp_host"],
+            self.options["smtp_port"],
+            self.options["smtp_user"],
+            self.options["smtp_password"],
+            self.options["smtp_starttls"],
+            self.options["smtp_timeout"],
+        )
+        if self.isdebug():
+            print(args)
+            print(body)
+        try:
+            pool.send(self.message(args, body))
+        except (smtplib.SMTPException, OSError) as ex:
+            print("NOTICE: smtp delivery failed: %s" % ex)
+            pool.close()
+            return 1
+        return 0
+
+    def __send_sendmail(self, args, body):
+        msg = self.message(args, body)
         p = Popen(["/usr/sbin/sendmail", "-t", "-oi"], stdin=PIPE)
         # Both Python 2.X and 3.X
         if self.isdebug():
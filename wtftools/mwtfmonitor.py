@@ -0,0 +1,273 @@
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import errno
+import os
+import select
+import signal
+import struct
+import time
+
+import mwtfalertable
+import mwtfpuppet
+import mwtfsummary
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_MOVED_FROM = 0x00000040
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+
+WATCH_MASK = (
+    IN_CLOSE_WRITE
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_MOVED_FROM
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+
+EVENT = struct.Struct("iIII")
+
+
+class MonitorStopped(Exception):
+    """Raised from the signal handler to leave the monitor loop."""
+
+    pass
+
+
+class InotifyWatcher:
+    """Wait for changes to one file by watching its directory with inotify."""
+
+    def __init__(self, pathname):
+        import ctypes
+        import ctypes.util
+
+        self.directory, self.name = os.path.split(pathname)
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(self.directory), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, os.strerror(err), self.directory)
+
+    def wait(self, timeout=None):
+        """Return True when the watched file changed before timeout seconds."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0)
+            ready, _, _ = select.select([self.fd], [], [], remaining)
+            if not ready:
+                return False
+            if self.__drain():
+                return True
+
+    def __drain(self):
+        changed = False
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = EVENT.unpack_from(buf, offset)
+                offset += EVENT.size
+                name = buf[offset : offset + length].rstrip(b"\0")
+                offset += length
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    raise FileNotFoundError(
+                        errno.ENOENT, "Watched directory went away", self.directory
+                    )
+                if os.fsdecode(name) == self.name:
+                    changed = True
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollWatcher:
+    """Fallback watcher comparing the file's stat key every interval seconds."""
+
+    def __init__(self, pathname, interval=60):
+        self.pathname = pathname
+        self.interval = interval
+        self.key = self.__stat_key()
+
+    def __stat_key(self):
+        try:
+            st = os.stat(self.pathname)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = self.interval
+            if deadline is not None:
+                delay = min(delay, max(deadline - time.monotonic(), 0))
+            time.sleep(delay)
+            key = self.__stat_key()
+            if key != self.key:
+                self.key = key
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+
+    def close(self):
+        pass
+
+
+class PuppetMonitor(mwtfpuppet.PuppetConfig):
+    """Resident puppet agent staleness monitor.
+
+    Paths are resolved once, last_run_summary.yaml is watched for changes and
+    alerts are raised or cleared only when the stale state changes.
+    """
+
+    ALERT_KEY = "puppet.lastrun.stale"
+
+    def __init__(self, opts={}):
+        mopts = {"stale_factor": 2.0, "poll_interval": 60, "inotify": True}
+        mopts.update(opts)
+        super().__init__(mopts)
+        self.stale = None
+        self.running = False
+        self.watcher = None
+        if self.pathnames["state"]["pn"] is None:
+            self.lastrun = None
+        else:
+            self.lastrun = os.path.join(
+                self.pathnames["state"]["pn"], "last_run_summary.yaml"
+            )
+
+    def threshold(self):
+        return int(self._run_interval() * float(self.options["stale_factor"]))
+
+    def last_run(self):
+        try:
+            summary = mwtfsummary.load(self.lastrun)
+        except FileNotFoundError:
+            return None
+        except Exception as ex:
+            self.warn("Unable to read %s: %s" % (self.lastrun, ex))
+            summary = None
+        if summary is not None and summary.last_run() > 0:
+            return summary.last_run()
+        try:
+            return int(os.stat(self.lastrun).st_mtime)
+        except FileNotFoundError:
+            return None
+
+    def check(self, now=None):
+        """Update the stale state and return seconds until it next could change.
+
+        None is returned when only a new run can change the state. A
+        transition the alerter rate limited is retried after poll_interval
+        seconds.
+        """
+        if now is None:
+            now = time.time()
+        threshold = self.threshold()
+        last = self.last_run()
+        if last is None:
+            age = None
+            stale = True
+        else:
+            age = int(now) - last
+            stale = age > threshold
+        if not self.__transition(stale, age, threshold):
+            return self.options["poll_interval"]
+        if stale:
+            return None
+        return threshold - age + 1
+
+    def run(self):
+        if self.lastrun is None:
+            self.fatal("Puppet state directory %s" % self.pathnames["state"]["status"])
+            return self.errors
+        self.running = True
+        previous = signal.signal(signal.SIGTERM, self.__stop)
+        try:
+            self.watcher = self.__watcher()
+            while self.running:
+                timeout = self.check()
+                self.debug("next check in %s seconds" % timeout)
+                try:
+                    self.watcher.wait(timeout)
+                except FileNotFoundError as ex:
+                    self.warn("%s, falling back to polling" % ex)
+                    self.watcher.close()
+                    self.watcher = PollWatcher(
+                        self.lastrun, self.options["poll_interval"]
+                    )
+        except (KeyboardInterrupt, MonitorStopped):
+            pass
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+            if self.watcher is not None:
+                self.watcher.close()
+                self.watcher = None
+        return self.errors
+
+    def cli_run(self):
+        if self.options.get("once"):
+            if self.lastrun is None:
+                self.fatal(
+                    "Puppet state directory %s" % self.pathnames["state"]["status"]
+                )
+            else:
+                self.check()
+                print("wtfo_puppet_stale=%s" % self.stale)
+            return self.errors
+        return self.run()
+
+    def __watcher(self):
+        if self.options["inotify"]:
+            try:
+                return InotifyWatcher(self.lastrun)
+            except (OSError, AttributeError) as ex:
+                self.info("inotify unavailable (%s), polling instead" % ex)
+        return PollWatcher(self.lastrun, self.options["poll_interval"])
+
+    def __transition(self, stale, age, threshold):
+        """Send a stale state change, return False if the alerter dropped it."""
+        if stale == self.stale:
+            return True
+        if stale:
+            if age is None:
+                subject = "Puppet has no last run summary"
+            else:
+                subject = "Puppet last ran %d seconds ago (limit %d)" % (age, threshold)
+            self.raise_alert(
+                {
+                    "key": self.ALERT_KEY,
+                    "subject": subject,
+                    "message": "%s. Please investigate." % subject,
+                }
+            )
+        else:
+            self.clear({"key": self.ALERT_KEY})
+        # the state is only committed once the alert store agrees with it
+        wanted = mwtfalertable.RAISED if stale else mwtfalertable.CLEARED
+        if self.alerts.state(self.ALERT_KEY) != wanted:
+            return False
+        self.stale = stale
+        return True
+
+    def __stop(self, signum, frame):
+        self.running = False
+        raise MonitorStopped()
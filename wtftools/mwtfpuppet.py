@@ -1,21 +1,79 @@
 # frozen_string_literal: true
 
-import configparser
+import collections
 import errno
 import os
+import re
+import types
 
 import mwtf
 import mwtfalertable
+import mwtfsummary
 
-# import re
 # import sys
 # from datetime import datetime
 
+FlagState = collections.namedtuple("FlagState", ["state", "mtime"])
+
+__SETTINGS__ = {}
+
+# puppet's own runinterval default and the units of its duration settings
+RUN_INTERVAL = 1800
+DURATION_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "y": 31536000}
+
+
+def parse_duration(value):
+    """Return a puppet duration such as 1800, 30m or 1h in seconds."""
+    match = re.fullmatch(r"\s*(\d+)\s*([smhdy]?)\s*", value)
+    if match is None:
+        raise ValueError("Invalid duration: %r" % value)
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+def load_settings(pathname):
+    """Return puppet.conf settings as a dict of plain dicts per section.
+
+    The file is parsed and interpolated once and cached process wide keyed on
+    (mtime, size, inode), a changed file is reloaded on the next call.
+    """
+    st = os.stat(pathname)
+    key = (st.st_mtime_ns, st.st_size, st.st_ino)
+    cached = __SETTINGS__.get(pathname)
+    if cached is not None and cached[0] == key:
+        mwtf.metrics().count("wtftools_cache_total", cache="settings", result="hit")
+        return cached[1]
+    mwtf.metrics().count("wtftools_cache_total", cache="settings", result="miss")
+    import configparser
+
+    with mwtf.metrics().span("wtftools_parse_seconds", kind="puppet.conf"):
+        parser = configparser.ConfigParser()
+        parser.read(pathname)
+        settings = {}
+        for section in parser:
+            values = {}
+            for option in parser[section]:
+                try:
+                    values[option] = parser.get(section, option)
+                except configparser.InterpolationError:
+                    values[option] = parser.get(section, option, raw=True)
+            settings[section] = values
+    __SETTINGS__[pathname] = (key, settings)
+    return settings
+
+
+def forget_settings(pathname=None):
+    if pathname is None:
+        __SETTINGS__.clear()
+    else:
+        __SETTINGS__.pop(pathname, None)
+
 
 class PuppetFlags(mwtfalertable.Alerter):
     def __init__(self, opts={}):
         super().__init__(opts)
-        if self.istest():
+        if self.options.get("flagdir") is not None:
+            self.flag_dir = self.options["flagdir"]
+        elif self.istest():
             self.flag_dir = "/tmp/flags"
         else:
             self.flag_dir = "/root/flags"
@@ -29,11 +87,32 @@ class PuppetFlags(mwtfalertable.Alerter):
     def flag_exists(self, flag):
         return os.path.exists(self.flag_fpn(flag))
 
-    def show_flags(self):
+    def snapshot(self):
+        """Return a read only mapping of flag to FlagState from one scandir."""
+        found = {}
+        states = {}
+        with self.span("wtftools_file_io_seconds", op="flag_snapshot"):
+            try:
+                with os.scandir(self.flag_dir) as it:
+                    for entry in it:
+                        if entry.name.endswith(".puppet"):
+                            found[entry.name[:-7]] = entry
+            except FileNotFoundError:
+                pass
+            for flag in self.flags():
+                entry = found.get(flag)
+                if entry is None:
+                    states[flag] = FlagState(False, None)
+                else:
+                    states[flag] = FlagState(True, entry.stat().st_mtime)
+        return types.MappingProxyType(states)
+
+    def show_flags(self, snapshot=None):
         self.__ensure_flag_directory()
+        if snapshot is None:
+            snapshot = self.snapshot()
         for flag in self.flags():
-            # print(flag)
-            print("wtfo_puppet_%s=%s" % (flag, self.flag_exists(flag)))
+            print("wtfo_puppet_%s=%s" % (flag, snapshot[flag].state))
         if self.istest():
             print("\ntest mode flagdir: %s" % self.flag_dir)
 
@@ -48,27 +127,106 @@ class PuppetFlags(mwtfalertable.Alerter):
             result = False
         return result
 
-    def manage(self, flag, action):
-        if self.isvalid(flag):
-            self.__ensure_flag_directory()
-            fpn = self.flag_fpn(flag)
-            exists = self.flag_exists(flag)
-            if action:
-                if not exists:
-                    os.system("touch %s" % fpn)
-            elif exists:
-                os.unlink(fpn)
+    def manage(self, flag, action, snapshot=None):
+        if not self.isvalid(flag):
+            return None
+        states, results = self.apply([(flag, action)], snapshot)
+        return states[flag]
+
+    def apply(self, changes, snapshot=None):
+        """Apply a batch of (flag, action) changes in one directory pass.
+
+        Returns the resulting states and a per flag result. When a flag
+        write fails the changes already made by the batch are rolled back.
+        """
+        states = dict(self.snapshot() if snapshot is None else snapshot)
+        results = collections.OrderedDict()
+        wanted = collections.OrderedDict()
+        for flag, action in changes:
+            if flag in self.flags():
+                wanted[flag] = bool(action)
+            else:
+                results[flag] = "invalid"
+        if not wanted:
+            return types.MappingProxyType(states), results
+
+        self.__ensure_flag_directory()
+        with self.span("wtftools_file_io_seconds", op="flag_apply"):
+            self.__apply(wanted, states, results)
+        return types.MappingProxyType(states), results
+
+    def __apply(self, wanted, states, results):
+        done = []
+        try:
+            for flag, action in wanted.items():
+                if action == states[flag].state:
+                    results[flag] = "unchanged"
+                    continue
+                if action:
+                    states[flag] = self.__create_flag(flag)
+                    results[flag] = "set"
+                else:
+                    states[flag] = self.__remove_flag(flag)
+                    results[flag] = "cleared"
+                done.append((flag, action))
+            if done and self.options.get("fsync"):
+                self.__fsync_flag_directory()
+        except OSError as ex:
+            self.error("Flag %s failed: %s" % (flag, ex))
+            results[flag] = "failed"
+            for prior, action in reversed(done):
+                try:
+                    if action:
+                        states[prior] = self.__remove_flag(prior)
+                    else:
+                        states[prior] = self.__create_flag(prior)
+                    results[prior] = "rolled back"
+                except OSError as rex:
+                    self.error("Flag %s rollback failed: %s" % (prior, rex))
+            for flag in wanted:
+                results.setdefault(flag, "skipped")
 
     def cli_run(self):
+        changes = []
         if self.options["clear"] is not None:
-            for flag in self.options["clear"]:
-                self.manage(flag, False)
+            changes.extend((flag, False) for flag in self.options["clear"])
         if self.options["set"] is not None:
-            for flag in self.options["set"]:
-                self.manage(flag, True)
-        self.show_flags()
+            changes.extend((flag, True) for flag in self.options["set"])
+        for flag, action in changes:
+            self.isvalid(flag)
+        states, results = self.apply(changes)
+        for flag, result in results.items():
+            self._verbose("%s: %s" % (flag, result))
+        self.show_flags(states)
         return self.errors
 
+    def __create_flag(self, flag):
+        fpn = self.flag_fpn(flag)
+        try:
+            fd = os.open(fpn, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            return FlagState(True, os.stat(fpn).st_mtime)
+        try:
+            if self.options.get("fsync"):
+                os.fsync(fd)
+            return FlagState(True, os.fstat(fd).st_mtime)
+        finally:
+            os.close(fd)
+
+    def __remove_flag(self, flag):
+        try:
+            os.unlink(self.flag_fpn(flag))
+        except FileNotFoundError:
+            pass
+        return FlagState(False, None)
+
+    def __fsync_flag_directory(self):
+        fd = os.open(self.flag_dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
     def __ensure_flag_directory(self):
         if not self.istest():
             mwtf.requires_super_user
@@ -83,8 +241,7 @@ class PuppetConfig(PuppetFlags):
         self.__init_pathnames()
 
     def setting(self, key, section="agent"):
-        if self.settings is None:
-            self.__load_config()
+        self.__load_config()
         if section in self.settings:
             return self.settings[section][key]
         self.warn("Section not found: %s" % section)
@@ -92,8 +249,7 @@ class PuppetConfig(PuppetFlags):
         return ""
 
     def show_section(self, section="agent"):
-        if self.settings is None:
-            self.__load_config()
+        self.__load_config()
         if section in self.settings:
             print("[%s]" % section)
             for key in self.settings[section]:
@@ -104,8 +260,7 @@ class PuppetConfig(PuppetFlags):
         return self.errors
 
     def show_setting(self, key, section="agent"):
-        if self.settings is None:
-            self.__load_config()
+        self.__load_config()
         if key is None:
             self.show_section(section)
         else:
@@ -114,8 +269,7 @@ class PuppetConfig(PuppetFlags):
         return self.errors
 
     def show_config(self):
-        if self.settings is None:
-            self.__load_config()
+        self.__load_config()
         label = None
         for section in self.settings:
             for key in self.settings[section]:
@@ -146,13 +300,30 @@ class PuppetConfig(PuppetFlags):
             self.errors += 1
             raise
 
+    def last_run_summary(self):
+        pn = self.pathname("lastrun")
+        if pn is None:
+            return None
+        return mwtfsummary.load(pn)
+
     # protected
 
     def _run_interval(self):
+        self.__load_config()
         if self.interval is None:
-            ri = int(self.setting("runinterval"))
+            ri = RUN_INTERVAL
+            # the agent reads runinterval from [agent], then from [main]
+            for section in ["agent", "main"]:
+                value = self.settings.get(section, {}).get("runinterval")
+                if value is None:
+                    continue
+                try:
+                    ri = parse_duration(value)
+                except ValueError as ex:
+                    self.warn("%s, using runinterval %d" % (ex, RUN_INTERVAL))
+                break
             if ri:
-                self.interval = int(ri)
+                self.interval = ri
             else:
                 self.interval = 7200
         return self.interval
@@ -220,11 +391,12 @@ class PuppetConfig(PuppetFlags):
         self.__init_file_pathname(possibles, "lastrun")
 
     def __load_config(self):
-        if self.settings is None:
-            if self.pathnames["config"]["pn"] is None:
-                raise FileNotFoundError(
-                    errno.ENOENT,
-                    "Puppet config file %s!!!" % self.pathnames["config"]["status"],
-                )
-            self.settings = configparser.ConfigParser()
-            self.settings.read(self.pathnames["config"]["pn"])
+        if self.pathnames["config"]["pn"] is None:
+            raise FileNotFoundError(
+                errno.ENOENT,
+                "Puppet config file %s!!!" % self.pathnames["config"]["status"],
+            )
+        settings = load_settings(self.pathnames["config"]["pn"])
+        if settings is not self.settings:
+            self.settings = settings
+            self.interval = None
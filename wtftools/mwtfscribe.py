@@ -1,17 +1,115 @@
 # -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil -*-
 
+import atexit
 import logging
-import logging.handlers
 import sys
+import threading
 
 import mwtf
 
-try:
-    from systemd.journal import JournalHandler
-except ImportError:
-    gJournal = False
-else:
-    gJournal = True
+
+class DeferredSinks(logging.Handler):
+    """Stand-in handler that builds the real sinks for the first record.
+
+    Building the sinks imports the logging handler stack, a run that logs
+    nothing never pays for it.
+    """
+
+    def __init__(self, sinks):
+        super().__init__()
+        self.sinks = sinks
+
+    def handle(self, record):
+        for handler in self.sinks.realize():
+            if record.levelno >= handler.level:
+                handler.handle(record)
+        return True
+
+
+class ScribeSinks:
+    """The handlers one Scribe configuration attaches to its logger.
+
+    The handlers are built by build() when the first record arrives. For
+    the queued mode handlers is the queue handler and targets are the sinks
+    the listener writes to.
+    """
+
+    def __init__(self, build):
+        self.key = None
+        self.build = build
+        self.log = None
+        self.deferred = None
+        self.lock = threading.Lock()
+        self.handlers = []
+        self.listener = None
+        self.targets = []
+        self.running = False
+
+    def attach(self, log):
+        self.log = log
+        self.deferred = DeferredSinks(self)
+        log.addHandler(self.deferred)
+
+    def realize(self):
+        """Build and attach the real handlers once, return them."""
+        with self.lock:
+            if self.deferred is not None:
+                self.handlers, self.listener, self.targets = self.build()
+                # swap in a new list, the logger may be iterating the old one
+                self.log.handlers = [
+                    h for h in self.log.handlers if h is not self.deferred
+                ] + self.handlers
+                self.deferred = None
+                if self.listener is not None:
+                    self.listener.start()
+                    self.running = True
+        return self.handlers
+
+    def flush(self):
+        if self.running:
+            self.listener.stop()
+            self.listener.start()
+
+    def detach(self, log):
+        if self.deferred is not None:
+            log.removeHandler(self.deferred)
+            self.deferred = None
+        if self.running:
+            self.listener.stop()
+            self.running = False
+        for handler in self.handlers:
+            log.removeHandler(handler)
+        for handler in self.handlers + self.targets:
+            handler.close()
+
+
+__SINKS__ = {}
+
+
+def scribe_sinks(log, key, build):
+    """Return the sinks attached to log for key, building them only once.
+
+    A logger carries one configuration at a time, asking for a different key
+    replaces the attached handlers instead of adding to them.
+    """
+    current = __SINKS__.get(log.name)
+    if current is not None and current.key == key:
+        return current
+    if current is not None:
+        current.detach(log)
+    elif not __SINKS__:
+        atexit.register(reset_sinks)
+    sinks = ScribeSinks(build)
+    sinks.key = key
+    sinks.attach(log)
+    __SINKS__[log.name] = sinks
+    return sinks
+
+
+def reset_sinks():
+    """Detach every configured sink, flushing queued records first."""
+    for name in list(__SINKS__):
+        __SINKS__.pop(name).detach(logging.getLogger(name))
 
 
 class Scribe(mwtf.Options):
@@ -34,18 +132,6 @@ class Scribe(mwtf.Options):
             else:
                 self.options["level"] = logging.WARNING
 
-        if ("logfile" in self.options) and (self.options["logfile"] is not None):
-            logging.basicConfig(
-                filename=self.options["logfile"], format="%(asctime)s - %(message)s"
-            )
-        elif gJournal:
-            self.log.addHandler(
-                JournalHandler(SYSLOG_IDENTIFIER=self.options["caller"])
-            )
-        else:
-            # TODO: SYSLOG_IDENTIFIER=self.options['caller']
-            self.log.addHandler(logging.handlers.SysLogHandler(address="/dev/log"))
-
         self.log.setLevel(self.options["level"])
 
         if self.options["loud"] and not self.options["screen"]:
@@ -53,14 +139,26 @@ class Scribe(mwtf.Options):
         if self.options["quiet"] and self.options["screen"]:
             self.options["screen"] = False
 
-        if self.options["screen"]:
-            console = logging.StreamHandler()
-            console.setLevel(self.options["level"])
-            # set a format which is simpler for console use
-            formatter = logging.Formatter("%(levelname)8s: %(message)s")
-            # tell the handler to use this format
-            console.setFormatter(formatter)
-            self.log.addHandler(console)
+        key = (
+            self.options.get("caller"),
+            self.options.get("logfile"),
+            self.options["level"],
+            self.options["screen"],
+            self.options.get("format", "text"),
+            bool(self.options.get("queued")),
+            self.options.get("queue_size", 10000),
+            self.options.get("overflow", "drop"),
+        )
+        self.sinks = scribe_sinks(self.log, key, self.__build_sinks)
+
+    def __build_sinks(self):
+        import mwtfsinks
+
+        return mwtfsinks.build(self.options)
+
+    def flush(self):
+        """Wait until every queued record has been written."""
+        self.sinks.flush()
 
     def debug(self, message, *args, **kwargs):
         self.log.debug(message, *args, **kwargs)
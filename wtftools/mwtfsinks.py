@@ -0,0 +1,150 @@
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+
+import mwtf
+
+try:
+    from systemd.journal import JournalHandler
+except ImportError:
+    gJournal = False
+else:
+    gJournal = True
+
+try:
+    import orjson
+except ImportError:
+    gOrjson = False
+else:
+    gOrjson = True
+
+# attributes every LogRecord has, anything else was passed as extra
+RECORD_ATTRS = frozenset(logging.makeLogRecord({}).__dict__) | {"message", "asctime"}
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler for a bounded queue with an overflow policy.
+
+    policy "drop" discards the new record, "drop_oldest" discards the oldest
+    queued record and "block" waits for room.
+    """
+
+    def __init__(self, records, policy="drop"):
+        super().__init__(records)
+        self.policy = policy
+        self.dropped = 0
+
+    def prepare(self, record):
+        """Queue a copy of the record for the listener to format.
+
+        The queue never leaves the process, so args, exc_info and extras are
+        kept for the sinks' formatters rather than folded into msg on the
+        logging thread.
+        """
+        return copy.copy(record)
+
+    def enqueue(self, record):
+        if self.policy == "block":
+            self.queue.put(record)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                self.dropped += 1
+                if self.policy != "drop_oldest":
+                    return
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+
+
+class JsonFormatter(logging.Formatter):
+    """Format a record as one JSON object with host, caller and extras.
+
+    Formatters only run for records that passed the logger and handler
+    level checks, so filtered records are never serialized.
+    """
+
+    def __init__(self, caller=None):
+        super().__init__()
+        self.caller = caller
+        self.host = mwtf.hostname()
+
+    def format(self, record):
+        data = {
+            "time": record.created,
+            "host": self.host,
+            "caller": self.caller,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRS:
+                data[key] = value
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exception"] = record.exc_text
+        return self.encode(data)
+
+    def encode(self, data):
+        if gOrjson:
+            try:
+                return orjson.dumps(data, default=str).decode()
+            except TypeError:
+                pass
+        return json.dumps(data, default=str, separators=(",", ":"))
+
+
+class DrainingQueueListener(logging.handlers.QueueListener):
+    """QueueListener whose stop waits for room in a full bounded queue."""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+def build(options):
+    """Return (handlers, listener, targets) for a Scribe's options.
+
+    For the queued mode handlers is the queue handler and targets are the
+    sinks the listener writes to.
+    """
+    handlers = []
+    if ("logfile" in options) and (options["logfile"] is not None):
+        handler = logging.FileHandler(options["logfile"])
+        handler.setFormatter(logging.Formatter("%(asctime)s - %(message)s"))
+        handlers.append(handler)
+    elif gJournal:
+        handlers.append(JournalHandler(SYSLOG_IDENTIFIER=options["caller"]))
+    else:
+        # TODO: SYSLOG_IDENTIFIER=options['caller']
+        handlers.append(logging.handlers.SysLogHandler(address="/dev/log"))
+    if options.get("format") == "json":
+        formatter = JsonFormatter(options.get("caller"))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+    if options["screen"]:
+        console = logging.StreamHandler()
+        console.setLevel(options["level"])
+        # set a format which is simpler for console use
+        formatter = logging.Formatter("%(levelname)8s: %(message)s")
+        # tell the handler to use this format
+        console.setFormatter(formatter)
+        handlers.append(console)
+
+    if not options.get("queued"):
+        return handlers, None, []
+    # put the sinks behind a bounded queue drained by a listener thread
+    records = queue.Queue(options.get("queue_size", 10000))
+    handler = BoundedQueueHandler(records, options.get("overflow", "drop"))
+    listener = DrainingQueueListener(records, *handlers, respect_handler_level=True)
+    return [handler], listener, handlers
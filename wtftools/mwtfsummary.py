@@ -0,0 +1,102 @@
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import os
+import time
+
+import mwtf
+
+__SUMMARIES__ = {}
+
+
+class RunSummary:
+    """Typed accessors for a parsed puppet last_run_summary.yaml."""
+
+    def __init__(self, data, pathname=None):
+        self.data = data if isinstance(data, dict) else {}
+        self.pathname = pathname
+
+    def __section(self, name):
+        section = self.data.get(name)
+        return section if isinstance(section, dict) else {}
+
+    def __count(self, section, key):
+        try:
+            return int(self.__section(section).get(key) or 0)
+        except (TypeError, ValueError):
+            return 0
+
+    def last_run(self):
+        return self.__count("time", "last_run")
+
+    def run_time(self):
+        try:
+            return float(self.__section("time").get("total") or 0.0)
+        except (TypeError, ValueError):
+            return 0.0
+
+    def age(self, now=None):
+        if now is None:
+            now = time.time()
+        return int(now) - self.last_run()
+
+    def config_version(self):
+        return self.__section("version").get("config")
+
+    def puppet_version(self):
+        return self.__section("version").get("puppet")
+
+    def resources(self):
+        result = {}
+        for key in self.__section("resources"):
+            result[key] = self.__count("resources", key)
+        return result
+
+    def resource_count(self, key="total"):
+        return self.__count("resources", key)
+
+    def changes(self):
+        return self.__count("changes", "total")
+
+    def failed_events(self):
+        return self.__count("events", "failure")
+
+    def failed_resources(self):
+        return self.__count("resources", "failed") + self.__count(
+            "resources", "failed_to_restart"
+        )
+
+    def failures(self):
+        """Return the number of failed resources.
+
+        Puppet counts a failed resource in both resources.failed and
+        events.failure, so the two are not added up.
+        """
+        return self.failed_resources()
+
+    def failed(self):
+        return self.failures() > 0 or self.failed_events() > 0 or not self.data
+
+
+def load(pathname):
+    """Return the RunSummary for pathname, parsing it only when it changed.
+
+    Parsed summaries are cached per path and keyed on (inode, mtime, size),
+    puppet rewrites the file by rename so any new run changes the key.
+    """
+    st = os.stat(pathname)
+    key = (st.st_ino, st.st_mtime_ns, st.st_size)
+    cached = __SUMMARIES__.get(pathname)
+    if cached is not None and cached[0] == key:
+        mwtf.metrics().count("wtftools_cache_total", cache="summary", result="hit")
+        return cached[1]
+    mwtf.metrics().count("wtftools_cache_total", cache="summary", result="miss")
+    summary = RunSummary(mwtf.load_yaml(pathname, mwtf.YAML_SAFE_LOADER), pathname)
+    __SUMMARIES__[pathname] = (key, summary)
+    return summary
+
+
+def forget(pathname=None):
+    if pathname is None:
+        __SUMMARIES__.clear()
+    else:
+        __SUMMARIES__.pop(pathname, None)
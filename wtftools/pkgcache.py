@@ -0,0 +1,109 @@
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import collections
+import json
+import os
+import time
+
+import mwtf
+
+__CACHES__ = {}
+
+
+class ResultCache:
+    """LRU cache of package query results with a time to live.
+
+    Keys are json encoded so the cache can be persisted as is; with a
+    pathname the entries are loaded from and saved to that json file, so
+    repeated lookups are shared between short lived commands. Entries older
+    than ttl seconds are never returned, the least recently used entries
+    are evicted beyond size entries.
+    """
+
+    def __init__(self, size=256, ttl=600, pathname=None):
+        self.size = size
+        self.ttl = ttl
+        self.pathname = pathname
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if pathname is not None:
+            self.load()
+
+    @staticmethod
+    def key(*parts):
+        return json.dumps(parts, separators=(",", ":"))
+
+    def get(self, key, now=None):
+        if now is None:
+            now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None and self.ttl is not None and now - entry[0] > self.ttl:
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            mwtf.metrics().count("wtftools_cache_total", cache="pkg", result="miss")
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        mwtf.metrics().count("wtftools_cache_total", cache="pkg", result="hit")
+        return entry[1]
+
+    def put(self, key, value, now=None):
+        if now is None:
+            now = time.time()
+        self.entries[key] = (now, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        self.save()
+
+    def invalidate(self, prefix=None):
+        """Drop every entry, or those whose key starts with the prefix parts."""
+        if prefix is None:
+            self.entries.clear()
+        else:
+            start = self.key(*prefix)[:-1] + ","
+            for key in [key for key in self.entries if key.startswith(start)]:
+                del self.entries[key]
+        self.save()
+
+    def load(self):
+        try:
+            with open(self.pathname) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for key, stamp, value in entries:
+            if self.ttl is None or now - stamp <= self.ttl:
+                self.entries[key] = (stamp, value)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        if self.pathname is None:
+            return
+        try:
+            mwtf.ensure_directory(os.path.dirname(self.pathname) or ".")
+            tmp = "%s.%d" % (self.pathname, os.getpid())
+            with open(tmp, "w") as f:
+                json.dump([[k, s, v] for k, (s, v) in self.entries.items()], f)
+            os.replace(tmp, self.pathname)
+        except OSError:
+            pass
+
+
+def result_cache(pathname=None, size=256, ttl=600):
+    """Return the process wide ResultCache for pathname, None is in memory."""
+    if pathname not in __CACHES__:
+        __CACHES__[pathname] = ResultCache(size, ttl, pathname)
+    return __CACHES__[pathname]
+
+
+def forget(pathname=None):
+    if pathname is None:
+        __CACHES__.clear()
+    else:
+        __CACHES__.pop(pathname, None)
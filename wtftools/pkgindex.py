@@ -0,0 +1,143 @@
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import os
+import sqlite3
+
+import mwtf
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS packages (
+    name TEXT NOT NULL,
+    version TEXT,
+    release TEXT,
+    arch TEXT,
+    UNIQUE (name, version, release, arch)
+);
+CREATE TABLE IF NOT EXISTS files (path TEXT NOT NULL, package TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS files_path ON files (path);
+CREATE INDEX IF NOT EXISTS files_package ON files (package);
+"""
+
+
+def default_index_dir():
+    if os.geteuid() == 0:
+        return "/var/cache/wtftools"
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache, "wtftools")
+
+
+def db_stamp(pathname):
+    """Return the newest mtime of pathname and, for a directory, its entries."""
+    try:
+        stamp = os.stat(pathname).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if os.path.isdir(pathname):
+        with os.scandir(pathname) as it:
+            for entry in it:
+                try:
+                    stamp = max(stamp, entry.stat(follow_symlinks=False).st_mtime_ns)
+                except FileNotFoundError:
+                    pass
+    return str(stamp)
+
+
+class PackageIndex(mwtf.Options):
+    """SQLite index of installed packages and the files they own.
+
+    The index is brought up to date before each lookup when the package
+    database stamp changed, only packages that were added, removed or
+    upgraded since the last update are re-read from the backend.
+    """
+
+    def __init__(self, handler, opts={}):
+        iopts = {"index_dir": None}
+        iopts.update(opts)
+        super().__init__(iopts)
+        self.handler = handler
+        directory = self.options["index_dir"] or default_index_dir()
+        self.pathname = os.path.join(
+            directory, "%s.sqlite" % handler.__class__.__name__.lower()
+        )
+        self.db = None
+
+    def connect(self):
+        if self.db is None:
+            mwtf.ensure_directory(os.path.dirname(self.pathname))
+            self.db = sqlite3.connect(self.pathname)
+            self.db.executescript(SCHEMA)
+        return self.db
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def stamp(self):
+        row = (
+            self.connect()
+            .execute("SELECT value FROM meta WHERE key = 'stamp'")
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def refresh(self, force=False):
+        """Update the index from the backend, return True when it changed."""
+        stamp = db_stamp(self.handler.db_path())
+        if not force and stamp is not None and stamp == self.stamp():
+            return False
+        with self.span("wtftools_index_refresh_seconds"):
+            self.__refresh(stamp, force)
+        return True
+
+    def __refresh(self, stamp, force):
+        db = self.connect()
+        current = set(self.handler.iter_installed())
+        if force:
+            indexed = set()
+        else:
+            indexed = set(
+                db.execute("SELECT name, version, release, arch FROM packages")
+            )
+        added = current - indexed
+        removed = indexed - current
+        stale = {r[0] for r in added | removed}
+        self.trace("index: %d added, %d removed" % (len(added), len(removed)))
+        with db:
+            if force:
+                db.execute("DELETE FROM packages")
+                db.execute("DELETE FROM files")
+            db.executemany(
+                "DELETE FROM packages WHERE name = ? AND version IS ? "
+                "AND release IS ? AND arch IS ?",
+                removed,
+            )
+            db.executemany("INSERT OR IGNORE INTO packages VALUES (?, ?, ?, ?)", added)
+            db.executemany("DELETE FROM files WHERE package = ?", ((n,) for n in stale))
+            names = sorted({r.name for r in current if r.name in stale})
+            if names:
+                db.executemany(
+                    "INSERT INTO files VALUES (?, ?)",
+                    ((path, name) for name, path in self.handler.iter_files(names)),
+                )
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('stamp', ?)", (stamp,))
+
+    def owners(self, path):
+        self.refresh()
+        rows = self.db.execute(
+            "SELECT DISTINCT package FROM files WHERE path = ? ORDER BY package",
+            (path,),
+        )
+        return [row[0] for row in rows]
+
+    def files(self, name):
+        self.refresh()
+        rows = self.db.execute(
+            "SELECT path FROM files WHERE package = ? ORDER BY path", (name,)
+        )
+        return [row[0] for row in rows]
+
+    def packages(self):
+        self.refresh()
+        return list(self.db.execute("SELECT * FROM packages ORDER BY name"))
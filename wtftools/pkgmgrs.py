@@ -1,10 +1,22 @@
 # -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil -*-
 
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import glob
+import json
 import os
+import shutil
 import subprocess
+import sys
+import tempfile
+import time
+import uuid
 
-# import distro
 import mwtf
+import pkgcache
+import pkgindex
 
 
 class Error(Exception):
@@ -24,7 +36,110 @@ class UsageError(Error):
         self.message = message
 
 
+def path_lookup(items):
+    """Map each item and its resolved path back to the item."""
+    lookup = {}
+    for item in items:
+        lookup[item] = item
+        lookup.setdefault(os.path.realpath(item), item)
+    return lookup
+
+
+def stanzas(text):
+    """Split blank line separated records into lists of lines."""
+    block = []
+    for line in text.splitlines():
+        if line.strip():
+            block.append(line)
+        elif block:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def stanza_field(block, field):
+    for line in block:
+        key, sep, value = line.partition(":")
+        if sep and key.strip() == field:
+            return value.strip()
+    return None
+
+
+def split_on_sentinel(text, sentinel, count):
+    """Split output lines into count groups separated by the sentinel line."""
+    groups = [[]]
+    for line in text.splitlines():
+        if line == sentinel:
+            groups.append([])
+        else:
+            groups[-1].append(line)
+    return groups[:count]
+
+
+DPKG_STATUS = "/var/lib/dpkg/status"
+DPKG_INFO = "/var/lib/dpkg/info"
+DPKG_FIELDS = ("Package", "Status", "Version", "Architecture")
+
+
+def iter_dpkg_status(pathname=DPKG_STATUS, fields=DPKG_FIELDS):
+    """Stream a dpkg status file, yielding a dict of fields per package.
+
+    Only the requested fields are kept, continuation lines are skipped.
+    """
+    wanted = set(fields)
+    stanza = {}
+    with open(pathname, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            if line == "\n":
+                if stanza:
+                    yield stanza
+                    stanza = {}
+            elif line[0] not in " \t":
+                key, sep, value = line.partition(":")
+                if sep and key in wanted:
+                    stanza[key] = value.strip()
+    if stanza:
+        yield stanza
+
+
+def split_release(version):
+    """Split a version-release string at its last dash."""
+    version, sep, release = version.rpartition("-")
+    if not sep:
+        return release, ""
+    return version, release
+
+
+PackageRecord = collections.namedtuple(
+    "PackageRecord", ["name", "version", "release", "arch"]
+)
+
+# exit status reported for commands killed on timeout, as timeout(1) does
+TIMEOUT_RESULT = 124
+
+CommandResult = collections.namedtuple(
+    "CommandResult", ["returncode", "stdout", "stderr"]
+)
+
+
+# actions answered from the result cache when the cache option is on
+CACHED_ACTIONS = ("file", "find", "info")
+
+
+def cmd_label(cmd):
+    """Return the program name of cmd for use as a metric label."""
+    if isinstance(cmd, str):
+        cmd = cmd.split()
+    return os.path.basename(cmd[0]) if cmd else ""
+
+
 class PackageHandler(mwtf.Options):
+    def __init__(self, opts={}):
+        popts = {"refresh": False, "names-only": None, "output": None, "quiet": False}
+        popts.update(opts)
+        mwtf.Options.__init__(self, popts)  # python2 compatibility
+
     def validate_arg_count(self, action, args, expected, extra=False):
         nbr = len(args)
         if nbr < expected:
@@ -38,157 +153,666 @@ class PackageHandler(mwtf.Options):
         print("class %s doesn't handle a file %s!" % (self.__class__.__name__, action))
         return 1
 
+    # the *_cmds methods return the commands an action runs, in order, or
+    # None when the handler does not support the action; the sync and the
+    # async dispatchers both run what they return
+
+    def file_cmds(self, args):
+        cmd = self.file_cmd(args[0])
+        return None if cmd is None else [cmd]
+
+    def find_cmds(self, args):
+        return None
+
+    def info_cmds(self, args):
+        cmd = self.info_cmd(args[0])
+        return None if cmd is None else [cmd]
+
+    def install_cmds(self, args):
+        return None
+
+    def uninstall_cmds(self, args):
+        return None
+
+    def list_package_cmds(self, args):
+        return None
+
+    def run_cmds(self, label, cmds):
+        if cmds is None:
+            return self.unhandled(label)
+        cache = self.result_cache()
+        if cache is not None:
+            if self.options.get("refresh"):
+                cache.invalidate((self.backend(),))
+            if label in CACHED_ACTIONS:
+                return self.run_cached(cache, label, cmds)
+        result = 0
+        for cmd in cmds:
+            result = self.execute(cmd)
+        if cache is not None and label in ("install", "uninstall"):
+            cache.invalidate((self.backend(),))
+        return result
+
+    def backend(self):
+        for name, handler in HANDLERS.items():
+            if type(self) is handler:
+                return name
+        return self.__class__.__name__.lower()
+
+    def result_cache(self):
+        """Return the result cache when the cache option is set, else None.
+
+        cache "disk" persists results next to the package index unless
+        cache_file names another file, any other true value keeps them in
+        memory for the life of the process.
+        """
+        if not self.options.get("cache"):
+            return None
+        pathname = self.options.get("cache_file")
+        if pathname is None and self.options["cache"] == "disk":
+            pathname = os.path.join(
+                pkgindex.default_index_dir(), "%s-results.json" % self.backend()
+            )
+        return pkgcache.result_cache(
+            pathname,
+            self.options.get("cache_size", 256),
+            self.options.get("cache_ttl", 600),
+        )
+
+    def run_cached(self, cache, label, cmds):
+        """Replay the cached answer of cmds or run them and cache it.
+
+        The key carries the package database stamp, so installs and removals
+        made by other processes are noticed without waiting for the ttl.
+        Only successful answers are cached.
+        """
+        stamp = None if self.db_path() is None else pkgindex.db_stamp(self.db_path())
+        key = cache.key(self.backend(), label, cmds, stamp)
+        found = cache.get(key)
+        if found is None:
+            result = 0
+            lines = []
+            for cmd in cmds:
+                captured = self.capture(cmd)
+                if captured.stderr:
+                    sys.stderr.write(captured.stderr)
+                lines.extend(captured.stdout.splitlines())
+                result = captured.returncode
+            found = [result, lines]
+            if result == 0:
+                cache.put(key, found)
+        self.render(found[1])
+        return found[0]
+
     def file_action(self, args):
-        return self.unhandled("file")
+        return self.run_cmds("file", self.file_cmds(args))
 
     def find_action(self, args):
-        return self.unhandled("find")
+        return self.run_cmds("find", self.find_cmds(args))
 
     def info_action(self, args):
-        return self.unhandled("info")
+        return self.run_cmds("info", self.info_cmds(args))
 
     def install_action(self, args):
-        return self.unhandled("install")
+        return self.run_cmds("install", self.install_cmds(args))
 
     def uninstall_action(self, args):
-        return self.unhandled("uninstall")
+        return self.run_cmds("uninstall", self.uninstall_cmds(args))
 
     def list_package(self, args):
-        return self.unhandled("list package")
+        cmds = self.list_package_cmds(args)
+        if cmds is None:
+            return self.unhandled("list package")
+        return self.render(line for cmd in cmds for line in self.stream(cmd))
 
     def list_packages(self):
         return self.unhandled("list packages")
 
-    def action(self, action, args):
-        if (self.options["debug"] > 0) or (self.options["verbose"] > 0):
-            print("action: " + action)
-            print("args: ", args)
+    def iter_installed(self):
+        """Yield a PackageRecord for every installed package."""
+        self.unhandled("installed packages")
+        return iter(())
+
+    def iter_files(self, names):
+        """Yield (package, path) for every file owned by the named packages."""
+        self.unhandled("package files")
+        return iter(())
+
+    def db_path(self):
+        return None
+
+    def index(self):
+        """Return the local package index, see pkgindex.PackageIndex."""
+        if getattr(self, "_index", None) is None:
+            self._index = pkgindex.PackageIndex(
+                self,
+                {
+                    "index_dir": self.options.get("index_dir"),
+                    "debug": self.options["debug"],
+                    "verbose": self.options["verbose"],
+                },
+            )
+        return self._index
+
+    def use_index(self):
+        return bool(self.options.get("index")) and self.db_path() is not None
+
+    def dispatch(self, action, args):
+        """Validate args and return the method implementing action.
+
+        Returns the method name and the parameters to call it with.
+        """
         if action == "file":
+            self.validate_arg_count(action, args, 1, True)
+            if len(args) > 1 or self.use_index():
+                return "show_batch", ("file", args)
+            return "file_action", (args,)
+        if (action == "find") or (action == "search"):
             self.validate_arg_count(action, args, 1)
-            result = self.file_action(args)
-        elif (action == "find") or (action == "search"):
-            self.validate_arg_count(action, args, 1)
-            result = self.find_action(args)
-        elif action == "info":
-            self.validate_arg_count(action, args, 1)
-            result = self.info_action(args)
-        elif action == "install":
+            return "find_action", (args,)
+        if action == "info":
             self.validate_arg_count(action, args, 1, True)
-            result = self.install_action(args)
-        elif action == "uninstall":
+            if len(args) > 1:
+                return "show_batch", ("info", args)
+            return "info_action", (args,)
+        if action == "install":
             self.validate_arg_count(action, args, 1, True)
-            result = self.uninstall_action(args)
-        elif action == "list":
+            return "install_action", (args,)
+        if action == "uninstall":
+            self.validate_arg_count(action, args, 1, True)
+            return "uninstall_action", (args,)
+        if action == "list":
             if len(args) > 0:
                 self.validate_arg_count(action, args, 1)
-                result = self.list_package(args)
-            else:
-                print("calling list packages")
-                result = self.list_packages()
-        else:
-            raise ValueError(action + " is not a valid action!!!")
+                if self.use_index():
+                    return "list_indexed", (args,)
+                return "list_package", (args,)
+            return "list_packages", ()
+        raise ValueError(action + " is not a valid action!!!")
+
+    def action(self, action, args):
+        if (self.options["debug"] > 0) or (self.options["verbose"] > 0):
+            print("action: " + action)
+            print("args: ", args)
+        name, params = self.dispatch(action, args)
+        if name == "list_packages":
+            print("calling list packages")
+        return getattr(self, name)(*params)
+
+    def list_indexed(self, args):
+        return self.render(self.index().files(args[0]))
+
+    def action_cmds(self, name, params):
+        """Return the commands a dispatched method runs, None if in process."""
+        if name.endswith("_action"):
+            return getattr(self, name[: -len("_action")] + "_cmds")(*params)
+        if name == "list_package":
+            return self.list_package_cmds(*params)
+        return None
+
+    async def async_action(self, action, args, timeout=None, on_line=None):
+        """Asynchronous twin of action().
+
+        Backend commands run with asyncio subprocesses, their stdout lines are
+        passed to on_line (print by default) as they arrive and each command
+        is killed after timeout seconds (the timeout option by default).
+        Actions answered in process run in the default executor.
+        """
+        if timeout is None:
+            timeout = self.options.get("timeout")
+        name, params = self.dispatch(action, args)
+        cmds = self.action_cmds(name, params)
+        if cmds is None:
+            loop = asyncio.get_running_loop()
+            method = functools.partial(getattr(self, name), *params)
+            return await loop.run_in_executor(None, method)
+        result = 0
+        for cmd in cmds:
+            result = await self.async_execute(cmd, timeout, on_line)
         return result
 
-    def execute(self, cmd):
+    async def async_execute(self, cmd, timeout=None, on_line=None):
+        if on_line is None:
+            on_line = print
         try:
-            subprocess.check_call(cmd)
-            result = 0
-        except subprocess.CalledProcessError as cpex:
-            if (self.options["debug"] > 0) or (self.options["verbose"] > 0):
-                print(cpex)
-            result = cpex.returncode
-        except Exception as ex:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.PIPE
+            )
+        except OSError as ex:
             print(ex)
-            result = 1
+            return 1
+        try:
+            return await asyncio.wait_for(self.__pump(proc, on_line), timeout)
+        except asyncio.TimeoutError:
+            await self.__kill(proc)
+            print("%s timed out after %s seconds" % (cmd[0], timeout))
+            return TIMEOUT_RESULT
+        except asyncio.CancelledError:
+            await self.__kill(proc)
+            raise
+
+    async def __pump(self, proc, on_line):
+        async for line in proc.stdout:
+            on_line(line.decode(errors="replace").rstrip("\n"))
+        return await proc.wait()
+
+    async def __kill(self, proc):
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+
+    def execute(self, cmd):
+        with self.span("wtftools_subprocess_seconds", cmd=cmd_label(cmd)):
+            try:
+                subprocess.check_call(cmd)
+                result = 0
+            except subprocess.CalledProcessError as cpex:
+                if (self.options["debug"] > 0) or (self.options["verbose"] > 0):
+                    print(cpex)
+                result = cpex.returncode
+            except Exception as ex:
+                print(ex)
+                result = 1
+        self.count_failure(cmd, result)
+        return result
+
+    def capture(self, cmd, env=None):
+        """Run cmd without a shell and return its CommandResult.
+
+        env replaces the environment of cmd when given.
+        """
+        with self.span("wtftools_subprocess_seconds", cmd=cmd_label(cmd)):
+            try:
+                proc = subprocess.run(
+                    cmd,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    universal_newlines=True,
+                    env=env,
+                )
+                result = CommandResult(proc.returncode, proc.stdout, proc.stderr)
+            except Exception as ex:
+                result = CommandResult(1, "", str(ex))
+        self.count_failure(cmd, result.returncode)
         return result
 
-    def output_if(self, cmd):
-        if self.options["output"] is not None:
-            if self.options["quiet"]:
-                cmd += " > %s" % self.options["output"]
+    def count_failure(self, cmd, result):
+        if result:
+            self.count("wtftools_subprocess_failures_total", cmd=cmd_label(cmd))
+
+    def jobs(self, count):
+        jobs = self.options.get("jobs") or min(8, os.cpu_count() or 1)
+        return max(1, min(jobs, count))
+
+    def execute_many(self, cmds, env=None):
+        """Run independent commands on a bounded pool, results in cmds order."""
+        if len(cmds) < 2:
+            return [self.capture(cmd, env) for cmd in cmds]
+        capture = functools.partial(self.capture, env=env)
+        with concurrent.futures.ThreadPoolExecutor(self.jobs(len(cmds))) as pool:
+            return list(pool.map(capture, cmds))
+
+    def file_cmd(self, arg):
+        return None
+
+    def info_cmd(self, arg):
+        return None
+
+    def file_batch_cmd(self, items):
+        return None
+
+    def info_batch_cmd(self, items):
+        return None
+
+    def parse_file_batch(self, items, result):
+        return {}
+
+    def parse_info_batch(self, items, result):
+        return {}
+
+    def arg_budget(self):
+        """Bytes of argv a single batch command may use."""
+        try:
+            limit = os.sysconf("SC_ARG_MAX")
+        except (ValueError, OSError):
+            limit = 131072
+        env = sum(len(k) + len(v) + 10 for k, v in os.environ.items())
+        return max(4096, min(limit // 2, limit - env - 4096))
+
+    def chunk_args(self, base, items, weight=1):
+        """Split items into lists that fit the argv budget after base."""
+        budget = self.arg_budget() - sum(len(os.fsencode(a)) + 9 for a in base)
+        size = self.options.get("batch_size") or len(items)
+        chunk = []
+        used = 0
+        for item in items:
+            cost = (len(os.fsencode(item)) + 9) * weight
+            if chunk and (used + cost > budget or len(chunk) >= size):
+                yield chunk
+                chunk = []
+                used = 0
+            chunk.append(item)
+            used += cost
+        if chunk:
+            yield chunk
+
+    def batch(self, kind, items, weight=1):
+        """Query many file or info items with one backend call per chunk.
+
+        Returns an ordered mapping of item to the parsed result, None for
+        items the backend knows nothing about.
+        """
+        results = collections.OrderedDict((item, None) for item in items)
+        builder = getattr(self, "%s_batch_cmd" % kind)
+        parser = getattr(self, "parse_%s_batch" % kind)
+        base = builder([])
+        if base is None:
+            self.unhandled(kind)
+            return results
+        chunks = list(self.chunk_args(base, items, weight))
+        cmds = [builder(chunk) for chunk in chunks]
+        # the parsers match the backends' untranslated messages
+        env = dict(os.environ, LC_ALL="C")
+        for chunk, result in zip(chunks, self.execute_many(cmds, env)):
+            if self.isdebug() and result.stderr:
+                print(result.stderr.rstrip())
+            for item, value in parser(chunk, result).items():
+                if item in results:
+                    results[item] = value
+        return results
+
+    def file_batch(self, paths):
+        """Return an ordered mapping of path to the list of owning packages."""
+        if self.use_index():
+            index = self.index()
+            return collections.OrderedDict(
+                (path, index.owners(path) or None) for path in paths
+            )
+        return self.batch("file", paths)
+
+    def info_batch(self, packages):
+        """Return an ordered mapping of package to its info text."""
+        return self.batch("info", packages)
+
+    def show_batch(self, kind, items):
+        results = getattr(self, "%s_batch" % kind)(items)
+        missing = 0
+        for item, value in results.items():
+            if not value:
+                missing += 1
+                print("%s: not found" % item)
+            elif kind == "file":
+                print("%s: %s" % (item, ", ".join(value)))
             else:
-                cmd += " | tee %s" % self.options["output"]
-        return os.system(cmd)
+                print(value.rstrip())
+                print()
+        return 1 if missing else 0
+
+    def stream(self, cmd):
+        """Yield the stdout lines of cmd as the backend produces them."""
+        start = time.perf_counter()
+        try:
+            proc = subprocess.Popen(
+                cmd, stdout=subprocess.PIPE, universal_newlines=True, bufsize=1
+            )
+        except OSError as ex:
+            print(ex)
+            self.errors += 1
+            self.count_failure(cmd, 1)
+            return
+        finished = False
+        try:
+            for line in proc.stdout:
+                yield line.rstrip("\n")
+            finished = True
+        finally:
+            proc.stdout.close()
+            if not finished and proc.poll() is None:
+                proc.terminate()
+            # a caller stopping early is not a backend failure
+            if proc.wait() and finished:
+                self.errors += 1
+                self.count_failure(cmd, proc.returncode)
+            self.metrics.observe(
+                "wtftools_subprocess_seconds",
+                time.perf_counter() - start,
+                cmd=cmd_label(cmd),
+            )
+
+    def render(self, lines):
+        """Print lines and copy them to the output option, like tee.
+
+        Returns 1 when a backend failed while producing lines, earlier
+        failures of the handler do not count.
+        """
+        errors = self.errors
+        output = self.options.get("output")
+        screen = output is None or not self.options.get("quiet")
+        f = open(output, "w") if output is not None else None
+        try:
+            for line in lines:
+                if screen:
+                    print(line)
+                if f is not None:
+                    f.write(line + "\n")
+        finally:
+            if f is not None:
+                f.close()
+        return 1 if self.errors > errors else 0
 
 
 class PacmanHandler(PackageHandler):
-    def list_package(self, args):
-        return self.output_if("pacman -Ql %s" % args[0])
+    def list_package_cmds(self, args):
+        return [["pacman", "-Ql", args[0]]]
 
     def list_packages(self):
-        result = self.output_if("pacman -Qe")
-        return result
+        return self.render(
+            "%s %s" % (r.name, "-".join(filter(None, (r.version, r.release))))
+            for r in self.iter_installed(True)
+        )
 
-    def file_action(self, args):
-        return self.execute(["pacman", "-Qo", args[0]])
+    def iter_installed(self, explicit=False):
+        cmd = ["pacman", "-Qe"] if explicit else ["pacman", "-Q"]
+        for line in self.stream(cmd):
+            name, sep, full = line.partition(" ")
+            if sep:
+                version, release = split_release(full)
+                yield PackageRecord(name, version, release, None)
 
-    def info_action(self, args):
-        return self.execute(["pacman", "-Qi", args[0]])
+    def db_path(self):
+        return "/var/lib/pacman/local"
 
-    def find_action(self, args):
+    def iter_files(self, names):
+        for chunk in self.chunk_args(["pacman", "-Ql"], names):
+            for line in self.stream(["pacman", "-Ql"] + chunk):
+                name, sep, path = line.partition(" ")
+                if sep:
+                    yield name, path
+
+    def file_cmd(self, arg):
+        return ["pacman", "-Qo", arg]
+
+    def info_cmd(self, arg):
+        return ["pacman", "-Qi", arg]
+
+    def file_batch_cmd(self, items):
+        return ["pacman", "-Qo"] + items
+
+    def info_batch_cmd(self, items):
+        return ["pacman", "-Qi"] + items
+
+    def parse_file_batch(self, items, result):
+        lookup = path_lookup(items)
+        found = {}
+        for line in result.stdout.splitlines():
+            path, sep, owner = line.partition(" is owned by ")
+            if sep and path in lookup:
+                found.setdefault(lookup[path], []).append(owner.split()[0])
+        return found
+
+    def parse_info_batch(self, items, result):
+        found = {}
+        for block in stanzas(result.stdout):
+            name = stanza_field(block, "Name")
+            if name in items:
+                found[name] = "\n".join(block)
+        return found
+
+    def find_cmds(self, args):
         switches = "-Ss"
         if self.options["refresh"]:
             mwtf.requires_super_user
             switches += "y"
-        return self.execute(["pacman", switches, args[0]])
+        return [["pacman", switches, args[0]]]
 
-    def install_action(self, args):
+    def install_cmds(self, args):
         mwtf.requires_super_user
         switches = "-S"
         if self.options["refresh"]:
-            switches = +"y"
+            switches += "y"
         cmd = ["pacman", switches]
         for i in args:
             cmd.append(i)
-        return self.execute(cmd)
+        return [cmd]
 
-    def uninstall_action(self, args):
+    def uninstall_cmds(self, args):
         mwtf.requires_super_user
         cmd = ["pacman", "-R"]
         for i in args:
             cmd.append(i)
-        return self.execute(cmd)
+        return [cmd]
 
 
 class AptHandler(PackageHandler):
+    def __init__(self, opts={}):
+        PackageHandler.__init__(self, opts)
+        self.status = DPKG_STATUS
+        self.infodir = DPKG_INFO
+
     def list_package(self, args):
-        return self.output_if("dpkg -L %s" % args[0])
+        pathname = self.list_pathname(args[0])
+        if pathname is None:
+            print("package %s is not installed" % args[0])
+            return 1
+        with open(pathname) as f:
+            return self.render(line.rstrip("\n") for line in f)
 
     def list_packages(self):
-        result = self.output_if(r"apt list --installed | sort")
-        return result
+        return self.render(
+            "%s %s %s"
+            % (r.name, "-".join(filter(None, (r.version, r.release))), r.arch)
+            for r in self.iter_installed()
+        )
 
-    def file_action(self, args):
-        return self.execute(["dpkg", "-S", args[0]])
+    def iter_installed(self):
+        for stanza in iter_dpkg_status(self.status):
+            if stanza.get("Status", "").endswith(" installed"):
+                version, release = split_release(stanza.get("Version", ""))
+                yield PackageRecord(
+                    stanza.get("Package"), version, release, stanza.get("Architecture")
+                )
 
-    def info_action(self, args):
-        return self.execute(["apt-cache", "show", args[0]])
+    def list_pathname(self, name, arch=None):
+        """Return the dpkg .list file for a package, None when not installed."""
+        name, sep, qualifier = name.partition(":")
+        candidates = [qualifier or arch, None]
+        for candidate in candidates:
+            if candidate:
+                listname = "%s:%s.list" % (name, candidate)
+            else:
+                listname = "%s.list" % name
+            pathname = os.path.join(self.infodir, listname)
+            if os.path.exists(pathname):
+                return pathname
+        if sep:
+            return None
+        matches = sorted(glob.glob(os.path.join(self.infodir, "%s:*.list" % name)))
+        return matches[0] if matches else None
 
-    def find_action(self, args):
+    def db_path(self):
+        return self.status
+
+    def iter_files(self, names):
+        wanted = set(names)
+        for record in self.iter_installed():
+            if record.name not in wanted:
+                continue
+            pathname = self.list_pathname(record.name, record.arch)
+            if pathname is None:
+                continue
+            with open(pathname) as f:
+                for line in f:
+                    yield record.name, line.rstrip("\n")
+
+    def file_cmd(self, arg):
+        return ["dpkg", "-S", arg]
+
+    def info_cmd(self, arg):
+        return ["apt-cache", "show", arg]
+
+    def file_batch_cmd(self, items):
+        return ["dpkg", "-S"] + items
+
+    def info_batch_cmd(self, items):
+        return ["apt-cache", "show"] + items
+
+    def parse_file_batch(self, items, result):
+        lookup = path_lookup(items)
+        found = {}
+        for line in result.stdout.splitlines():
+            if line.startswith("diversion by "):
+                continue
+            owners, sep, path = line.partition(": ")
+            if sep and path in lookup:
+                found.setdefault(lookup[path], []).extend(
+                    owner.strip() for owner in owners.split(",")
+                )
+        return found
+
+    def parse_info_batch(self, items, result):
+        names = {}
+        for item in items:
+            name = item.split("=")[0].split("/")[0].split(":")[0]
+            names.setdefault(name, []).append(item)
+        found = {}
+        for block in stanzas(result.stdout):
+            for item in names.get(stanza_field(block, "Package"), []):
+                text = "\n".join(block)
+                found[item] = found[item] + "\n\n" + text if item in found else text
+        return found
+
+    def find_cmds(self, args):
+        cmds = []
         if self.options["refresh"]:
             mwtf.requires_super_user
-            self.execute(["apt", "update"])
+            cmds.append(["apt", "update"])
         cmd = ["apt", "search"]
         if self.options["names-only"] is not None:
             cmd.append("--names-only")
         cmd.append(args[0])
-        return self.execute(cmd)
+        cmds.append(cmd)
+        return cmds
 
-    def install_action(self, args):
+    def install_cmds(self, args):
         mwtf.requires_super_user
+        cmds = []
         if self.options["refresh"]:
-            self.execute(["apt", "update"])
+            cmds.append(["apt", "update"])
         cmd = ["apt", "install"]
         for i in args:
             cmd.append(i)
-        return self.execute(cmd)
+        cmds.append(cmd)
+        return cmds
 
-    def uninstall_action(self, args):
+    def uninstall_cmds(self, args):
         mwtf.requires_super_user
         cmd = ["apt", "remove"]
         for i in args:
             cmd.append(i)
-        return self.execute(cmd)
+        return [cmd]
 
 
 class YumHandler(PackageHandler):
@@ -196,43 +820,107 @@ class YumHandler(PackageHandler):
         PackageHandler.__init__(self, opts)  # python2 compatibility
         self.pkgcmd = "yum"
 
-    def list_package(self, args):
-        return self.output_if("rpm -ql %s" % args[0])
+    def list_package_cmds(self, args):
+        return [["rpm", "-ql", args[0]]]
 
     def list_packages(self):
-        result = self.output_if(
-            "rpm -qa --qf '%{name}-%{version}-%{release}.%{arch}.rpm\\n' | sort"
+        return self.render(
+            sorted("%s-%s-%s.%s.rpm" % record for record in self.iter_installed())
         )
-        return result
 
-    def file_action(self, args):
-        return self.execute(["rpm", "-qf", args[0]])
+    def iter_installed(self):
+        fmt = "%{NAME}\\t%{VERSION}\\t%{RELEASE}\\t%{ARCH}\\n"
+        for line in self.stream(["rpm", "-qa", "--qf", fmt]):
+            fields = line.split("\t")
+            if len(fields) == 4:
+                yield PackageRecord(*fields)
 
-    def info_action(self, args):
-        return self.execute(["rpm", "-qi", args[0]])
+    def db_path(self):
+        return "/var/lib/rpm"
 
-    def find_action(self, args):
+    def iter_files(self, names):
+        fmt = "[%{NAME}\\t%{FILENAMES}\\n]"
+        base = ["rpm", "-q", "--qf", fmt]
+        for chunk in self.chunk_args(base, names):
+            for line in self.stream(base + chunk):
+                name, sep, path = line.partition("\t")
+                if sep:
+                    yield name, path
+
+    def file_cmd(self, arg):
+        return ["rpm", "-qf", arg]
+
+    def info_cmd(self, arg):
+        return ["rpm", "-qi", arg]
+
+    # rpm gives no hint which argument a line of output belongs to, so the
+    # batch arguments are interleaved with a sentinel whose output is known
+
+    def file_batch(self, paths):
+        if self.use_index():
+            return super().file_batch(paths)
+        with tempfile.NamedTemporaryFile(prefix="wtftools-sentinel-") as f:
+            self.sentinel = f.name
+            return self.batch("file", paths, 2)
+
+    def info_batch(self, packages):
+        self.sentinel = "wtftools-sentinel-%s" % uuid.uuid4().hex
+        return self.batch("info", packages, 2)
+
+    def interleave(self, items):
+        args = []
+        for item in items:
+            args.extend([item, self.sentinel])
+        return args
+
+    def file_batch_cmd(self, items):
+        return ["rpm", "-qf", "--qf", "%{NAME}\\n"] + self.interleave(items)
+
+    def info_batch_cmd(self, items):
+        return ["rpm", "-qi"] + self.interleave(items)
+
+    def parse_file_batch(self, items, result):
+        sentinel = "file %s is not owned by any package" % self.sentinel
+        found = {}
+        groups = split_on_sentinel(result.stdout, sentinel, len(items))
+        for item, lines in zip(items, groups):
+            found[item] = [
+                line for line in lines if line and not line.startswith("file ")
+            ]
+        return found
+
+    def parse_info_batch(self, items, result):
+        sentinel = "package %s is not installed" % self.sentinel
+        found = {}
+        groups = split_on_sentinel(result.stdout, sentinel, len(items))
+        for item, lines in zip(items, groups):
+            text = "\n".join(lines).strip()
+            if text and not text.startswith("package "):
+                found[item] = text
+        return found
+
+    def find_cmds(self, args):
         cmd = [self.pkgcmd, "search", args[0]]
         if self.options["refresh"]:
             mwtf.requires_super_user
             cmd.insert(1, "--refresh")
-        return self.execute(cmd)
+        return [cmd]
 
-    def install_action(self, args):
+    def install_cmds(self, args):
         mwtf.requires_super_user
         cmd = [self.pkgcmd, "install"]
         for i in args:
             cmd.append(i)
         if self.options["refresh"]:
             cmd.insert(1, "--refresh")
-        return self.execute(cmd)
+        return [cmd]
 
-    def uninstall_action(self, args):
+    def uninstall_cmds(self, args):
         mwtf.requires_super_user
         cmd = [self.pkgcmd, "remove"]
         for i in args:
             cmd.append(i)
-        return self.execute(cmd)
+        return [cmd]
 
 
 class DnfHandler(YumHandler):
@@ -241,3 +929,117 @@ class DnfHandler(YumHandler):
         self.pkgcmd = "dnf"
         if self.options["test"]:
             print("created instance of DnfHandler")
+
+
+HANDLERS = {
+    "pacman": PacmanHandler,
+    "apt": AptHandler,
+    "yum": YumHandler,
+    "dnf": DnfHandler,
+}
+
+# os-release ID or ID_LIKE to backend, dnf is preferred over yum if present
+DISTRO_BACKENDS = {
+    "arch": "pacman",
+    "manjaro": "pacman",
+    "endeavouros": "pacman",
+    "debian": "apt",
+    "ubuntu": "apt",
+    "fedora": "dnf",
+    "rhel": "dnf",
+    "centos": "dnf",
+    "rocky": "dnf",
+    "almalinux": "dnf",
+    "ol": "dnf",
+    "amzn": "dnf",
+}
+
+BACKEND_BINARIES = [
+    ("dnf", "dnf"),
+    ("yum", "yum"),
+    ("apt", "dpkg"),
+    ("pacman", "pacman"),
+]
+
+OS_RELEASE = ["/etc/os-release", "/usr/lib/os-release"]
+
+
+def read_os_release(choices=None):
+    """Return the os-release fields as a dict and the file's stat key."""
+    for pathname in OS_RELEASE if choices is None else choices:
+        try:
+            with open(pathname) as f:
+                st = os.fstat(f.fileno())
+                fields = {}
+                for line in f:
+                    key, sep, value = line.strip().partition("=")
+                    if sep and not key.startswith("#"):
+                        fields[key] = value.strip("\"'")
+        except FileNotFoundError:
+            continue
+        return fields, [pathname, st.st_mtime_ns, st.st_size]
+    return {}, None
+
+
+def probe_backend(fields):
+    """Return (backend, binary path) for the os-release fields, or None."""
+    ids = [fields.get("ID", "")] + fields.get("ID_LIKE", "").split()
+    for distro in ids:
+        backend = DISTRO_BACKENDS.get(distro)
+        if backend is None:
+            continue
+        if backend == "dnf" and shutil.which("dnf") is None:
+            backend = "yum"
+        binary = shutil.which(dict(BACKEND_BINARIES)[backend])
+        if binary is not None:
+            return backend, binary
+    for backend, name in BACKEND_BINARIES:
+        binary = shutil.which(name)
+        if binary is not None:
+            return backend, binary
+    return None
+
+
+def detect_backend(cache_file=None):
+    """Return the package backend name for this host.
+
+    The result is cached in cache_file and reused while os-release is
+    unchanged and the backend binary is still executable.
+    """
+    if cache_file is None:
+        cache_file = os.path.join(pkgindex.default_index_dir(), "backend.json")
+    fields, stamp = read_os_release()
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if (
+            cached["os_release"] == stamp
+            and cached["backend"] in HANDLERS
+            and os.access(cached["binary"], os.X_OK)
+        ):
+            return cached["backend"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    found = probe_backend(fields)
+    if found is None:
+        raise Error("No supported package manager found")
+    backend, binary = found
+    try:
+        mwtf.ensure_directory(os.path.dirname(cache_file))
+        tmp = "%s.%d" % (cache_file, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump({"backend": backend, "binary": binary, "os_release": stamp}, f)
+        os.replace(tmp, cache_file)
+    except OSError:
+        pass
+    return backend
+
+
+def create_handler(opts={}, backend=None, cache_file=None):
+    """Return a handler instance for backend, detected when not given."""
+    if backend is None:
+        backend = detect_backend(cache_file)
+    try:
+        return HANDLERS[backend](opts)
+    except KeyError:
+        raise UsageError("unsupported package backend %s" % backend)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import os.path
+import sys
+from optparse import OptionParser
+
+import mwtf
+import mwtfpuppet
+
+
+def run(options, args):
+    config = mwtfpuppet.PuppetConfig(options)
+    if options["all"]:
+        return config.show_config()
+    return config.show_setting(args[0] if args else None, options["section"])
+
+
+def main():
+    usage = """usage: %prog [options] [setting]
+
+  show a puppet.conf setting, a whole section when no setting is given
+
+  """
+    parser = OptionParser(usage)
+    parser.add_option(
+        "-a",
+        "--all",
+        action="store_true",
+        dest="all",
+        default=False,
+        help="show every section",
+    )
+    parser.add_option(
+        "-d",
+        "--debug",
+        action="count",
+        dest="debug",
+        default=0,
+        help="increment debug level",
+    )
+    parser.add_option(
+        "-s",
+        "--section",
+        action="store",
+        dest="section",
+        default="agent",
+        help="section to look in (default agent)",
+    )
+    parser.add_option(
+        "-t",
+        "--test",
+        action="store_true",
+        dest="test",
+        default=False,
+        help="specify test mode",
+    )
+    parser.add_option(
+        "-v",
+        "--verbose",
+        action="count",
+        dest="verbose",
+        default=0,
+        help="increment verbosity level",
+    )
+    parser.add_option(
+        "-V",
+        "--version",
+        action="store_true",
+        dest="version",
+        default=False,
+        help="show version and exit",
+    )
+
+    mwtf.add_profile_options(parser)
+
+    (opts, args) = parser.parse_args()
+
+    basenm = os.path.basename(sys.argv[0])
+    options = vars(opts)
+    if options["debug"] > 1:
+        print(options)
+        print(args)
+
+    if options["version"]:
+        print("%s Version: 1.0.0" % basenm)
+        exit(0)
+
+    if len(args) > 1:
+        parser.error("specify at most one setting")
+
+    options["caller"] = basenm
+    exit(mwtf.profiled(options, run, options, args))
+
+
+if __name__ == "__main__":
+    main()
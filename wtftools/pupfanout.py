@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import os.path
+import sys
+from optparse import OptionParser
+
+import mwtf
+import mwtffanout
+
+
+def read_hosts(pathname):
+    hosts = []
+    with sys.stdin if pathname == "-" else open(pathname) as f:
+        for line in f:
+            host = line.split("#", 1)[0].strip()
+            if host:
+                hosts.append(host)
+    return hosts
+
+
+def run(options, hosts):
+    fanout = mwtffanout.FanOut(options)
+    return fanout.cli_run(hosts)
+
+
+def main():
+    usage = """usage: %prog [options] [host ...]
+
+  query puppet flags, or one puppet.conf setting, on many hosts at once
+
+  """
+    parser = OptionParser(usage)
+    parser.add_option(
+        "-d",
+        "--debug",
+        action="count",
+        dest="debug",
+        default=0,
+        help="increment debug level",
+    )
+    parser.add_option(
+        "-H",
+        "--hosts-file",
+        action="store",
+        dest="hosts_file",
+        help="read hosts from file, one per line (- for stdin)",
+    )
+    parser.add_option(
+        "-j",
+        "--jobs",
+        action="store",
+        type="int",
+        dest="jobs",
+        default=32,
+        help="hosts to query at once (default 32)",
+    )
+    parser.add_option(
+        "-l",
+        "--local",
+        action="store_true",
+        dest="local",
+        default=False,
+        help="run the query on this host instead of over ssh",
+    )
+    parser.add_option(
+        "-o",
+        "--ssh-option",
+        action="append",
+        dest="ssh_options",
+        default=[],
+        help="pass an -o option to ssh",
+    )
+    parser.add_option(
+        "-s",
+        "--setting",
+        action="store",
+        dest="setting",
+        help="query a puppet.conf setting instead of the flags",
+    )
+    parser.add_option(
+        "-S",
+        "--section",
+        action="store",
+        dest="section",
+        default="agent",
+        help="section of the setting (default agent)",
+    )
+    parser.add_option(
+        "-T",
+        "--timeout",
+        action="store",
+        type="float",
+        dest="timeout",
+        default=60,
+        help="seconds before a host is given up on (default 60)",
+    )
+    parser.add_option(
+        "-t",
+        "--test",
+        action="store_true",
+        dest="test",
+        default=False,
+        help="specify test mode",
+    )
+    parser.add_option(
+        "-v",
+        "--verbose",
+        action="count",
+        dest="verbose",
+        default=0,
+        help="increment verbosity level",
+    )
+    parser.add_option(
+        "-V",
+        "--version",
+        action="store_true",
+        dest="version",
+        default=False,
+        help="show version and exit",
+    )
+
+    mwtf.add_profile_options(parser)
+
+    (opts, args) = parser.parse_args()
+
+    basenm = os.path.basename(sys.argv[0])
+    options = vars(opts)
+    if options["debug"] > 1:
+        print(options)
+        print(args)
+
+    if options["version"]:
+        print("%s Version: 1.0.0" % basenm)
+        exit(0)
+
+    hosts = list(args)
+    if options["hosts_file"] is not None:
+        hosts.extend(read_hosts(options["hosts_file"]))
+    if not hosts:
+        parser.error("no hosts specified")
+
+    options["caller"] = basenm
+    if options["local"]:
+        options["transport"] = mwtffanout.LocalTransport()
+    else:
+        options["transport"] = mwtffanout.SshTransport(options=options["ssh_options"])
+    exit(mwtf.profiled(options, run, options, hosts))
+
+
+if __name__ == "__main__":
+    main()
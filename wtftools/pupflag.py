@@ -5,9 +5,15 @@ import os.path
 import sys
 from optparse import OptionParser
 
+import mwtf
 import mwtfpuppet
 
 
+def run(options, args):
+    flagger = mwtfpuppet.PuppetFlags(options)
+    return flagger.cli_run()
+
+
 def main():
     usage = """usage: %prog [options]
 
@@ -26,6 +32,14 @@ def main():
         default=0,
         help="increment debug level",
     )
+    parser.add_option(
+        "-f",
+        "--fsync",
+        action="store_true",
+        dest="fsync",
+        default=False,
+        help="fsync flag changes to disk",
+    )
     parser.add_option(
         "-s", "--set", action="append", dest="set", help="specify flag to set)"
     )
@@ -54,6 +68,8 @@ def main():
         help="show version and exit",
     )
 
+    mwtf.add_profile_options(parser)
+
     (opts, args) = parser.parse_args()
 
     basenm = os.path.basename(sys.argv[0])
@@ -67,8 +83,7 @@ def main():
         exit(0)
 
     options["caller"] = basenm
-    flagger = mwtfpuppet.PuppetFlags(options)
-    exit(flagger.cli_run())
+    exit(mwtf.profiled(options, run, options, args))
 
 
 if __name__ == "__main__":
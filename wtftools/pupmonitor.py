@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil -*-
+
+import os.path
+import sys
+from optparse import OptionParser
+
+import mwtf
+import mwtfmonitor
+
+
+def run(options, args):
+    monitor = mwtfmonitor.PuppetMonitor(options)
+    return monitor.cli_run()
+
+
+def main():
+    usage = """usage: %prog [options]
+
+  watch the puppet last run summary and alert when the agent goes stale
+
+  """
+    parser = OptionParser(usage)
+    parser.add_option(
+        "-d",
+        "--debug",
+        action="count",
+        dest="debug",
+        default=0,
+        help="increment debug level",
+    )
+    parser.add_option(
+        "-f",
+        "--stale-factor",
+        action="store",
+        type="float",
+        dest="stale_factor",
+        default=2.0,
+        help="runinterval multiple after which the agent is stale",
+    )
+    parser.add_option(
+        "-o",
+        "--once",
+        action="store_true",
+        dest="once",
+        default=False,
+        help="check staleness once and exit",
+    )
+    parser.add_option(
+        "-p",
+        "--poll-interval",
+        action="store",
+        type="int",
+        dest="poll_interval",
+        default=60,
+        help="seconds between checks when inotify is not used",
+    )
+    parser.add_option(
+        "-P",
+        "--no-inotify",
+        action="store_false",
+        dest="inotify",
+        default=True,
+        help="poll instead of using inotify",
+    )
+    parser.add_option(
+        "-t",
+        "--test",
+        action="store_true",
+        dest="test",
+        default=False,
+        help="specify test mode",
+    )
+    parser.add_option(
+        "-v",
+        "--verbose",
+        action="count",
+        dest="verbose",
+        default=0,
+        help="increment verbosity level",
+    )
+    parser.add_option(
+        "-V",
+        "--version",
+        action="store_true",
+        dest="version",
+        default=False,
+        help="show version and exit",
+    )
+
+    mwtf.add_profile_options(parser)
+
+    (opts, args) = parser.parse_args()
+
+    basenm = os.path.basename(sys.argv[0])
+    options = vars(opts)
+    if options["debug"] > 1:
+        print(options)
+        print(args)
+
+    if options["version"]:
+        print("%s Version: 1.0.0" % basenm)
+        exit(0)
+
+    options["caller"] = basenm
+    exit(mwtf.profiled(options, run, options, args))
+
+
+if __name__ == "__main__":
+    main()